@@ -0,0 +1,458 @@
+import asyncio
+import functools
+import json
+from pathlib import Path
+
+from aliyunpan.api.core import AliyunPan
+from aliyunpan.api.type import Share
+from aliyunpan.api.utils import logger, get_sha1_proof, get_proof_code, FileMap
+from aliyunpan.exceptions import AliyunpanCode, AliyunpanException, InvalidAccessToken, InvalidContentHash, \
+    InvalidParentFileId, PartNumberOverLimit, UploadUrlFailedRefresh
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+__all__ = ['AsyncAliyunPan', 'AsyncResponse']
+
+
+class AsyncResponse:
+    """
+    已读取的响应，json只解析一次
+    """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        if '_json' not in self.__dict__:
+            self._json = json.loads(self.content or b'{}')
+        return self._json
+
+
+class AsyncAliyunPan:
+    """
+    基于aiohttp的异步客户端，token和drive_id由同步的AliyunPan维护
+    """
+
+    def __init__(self, refresh_token: str = None, album: bool = False, share: Share = Share(),
+                 disk: AliyunPan = None, max_connections: int = 8, timeout: float = 10):
+        self._disk = disk or AliyunPan(refresh_token, album, share)
+        self._max_connections = max_connections
+        self._timeout = timeout
+        self._retry_num = 3
+        self._session = None
+        self._semaphore = None
+        self._upload_url_lock = None
+        self._headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) '
+                          'Chrome/87.0.4280.88 Safari/537.36',
+            'Referer': 'https://www.aliyundrive.com/'
+        }
+
+    disk = property(lambda self: self._disk)
+    share = property(lambda self: self._disk.share)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        if not self._session:
+            if not aiohttp:
+                logger.error('Cannot find module aiohttp.')
+                raise ImportError('aiohttp is required by AsyncAliyunPan, install it with: pip install aliyunpan[aio]')
+            self._session = aiohttp.ClientSession(headers=self._headers,
+                                                  connector=aiohttp.TCPConnector(limit=self._max_connections,
+                                                                                 ssl=False),
+                                                  timeout=aiohttp.ClientTimeout(total=self._timeout))
+            self._semaphore = asyncio.Semaphore(self._max_connections)
+            self._upload_url_lock = asyncio.Lock()
+        return self._session
+
+    @staticmethod
+    async def _run(func, *args, **kwargs):
+        """
+        在线程池中运行同步函数
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def get_access_token(self) -> str:
+        disk = self._disk
+        access_token = disk._access_token
+        if access_token and (disk._refresh_token_expires is None
+                             or disk.refresh_token_expires_sec > disk._token_refresh_margin):
+            return access_token
+        return await self._run(disk.refresh_access_token, access_token)
+
+    async def get_drive_id(self) -> str:
+        return self._disk._drive_id or await self._run(lambda: self._disk.drive_id)
+
+    async def request(self, method, url, access_token=True, depth=None, **kwargs) -> AsyncResponse:
+        """
+        发送请求，access_token失效时刷新后重试
+        :param method:
+        :param url:
+        :param access_token: 是否携带access_token，也可以直接指定
+        :param depth: 剩余重试次数
+        :return:
+        """
+        session = self._get_session()
+        if depth is None:
+            depth = self._retry_num
+        headers = dict(kwargs.pop('headers', None) or {})
+        if access_token is True:
+            token = await self.get_access_token()
+        else:
+            token = access_token or None
+        if token:
+            headers['Authorization'] = token
+        async with self._semaphore:
+            logger.debug(f'{method.lower()}, {url}')
+            async with session.request(method, url, headers=headers, **kwargs) as r:
+                response = AsyncResponse(r.status, r.headers, await r.read())
+        if response.status_code == 401 and access_token is True:
+            if not depth:
+                raise InvalidAccessToken
+            logger.info('Access token is invalid.')
+            await self._run(self._disk.refresh_access_token, token)
+            return await self.request(method, url, access_token, depth - 1, headers=headers, **kwargs)
+        return response
+
+    async def post(self, url, **kwargs) -> AsyncResponse:
+        return await self.request('POST', url, **kwargs)
+
+    async def get_file_list(self, parent_file_id: str = 'root', next_marker: str = None) -> list:
+        """
+        获取文件列表
+        :param parent_file_id:
+        :param next_marker:
+        :return:
+        """
+        return [i async for i in self.iter_file_list(parent_file_id, next_marker)]
+
+    async def iter_file_list(self, parent_file_id: str = 'root', next_marker: str = None):
+        """
+        逐页获取文件列表
+        :param parent_file_id:
+        :param next_marker:
+        :return:
+        """
+        url = 'https://api.aliyundrive.com/adrive/v3/file/list'
+        share = self._disk.share
+        while True:
+            json = {'parent_file_id': parent_file_id}
+            if next_marker:
+                json['marker'] = next_marker
+            headers = {}
+            kwargs = {}
+            if share.share_id:
+                json.update({'share_id': share.share_id, 'share_pwd': share.share_pwd})
+                headers = {'x-share-token': await self._run(self._disk.get_share_token)}
+                kwargs = {'access_token': None}
+            else:
+                json.update({'drive_id': await self.get_drive_id(), 'fields': '*'})
+            logger.info(f'Get the list of parent_file_id {parent_file_id}.')
+            data = (await self.post(url, json=json, headers=headers, **kwargs)).json()
+            if 'items' not in data:
+                return
+            for item in data['items']:
+                yield item
+            if not data.get('next_marker') or next_marker == data['next_marker']:
+                return
+            next_marker = data['next_marker']
+
+    async def search(self, query: str, raw=False, next_marker: str = None, limit_num: int = 100, limit: bool = False,
+                     category_list=None) -> list:
+        """
+        搜索文件
+        """
+        return [i async for i in self.iter_search(query, raw, next_marker, limit_num, limit, category_list)]
+
+    async def iter_search(self, query: str, raw=False, next_marker: str = None, limit_num: int = 100,
+                          limit: bool = False, category_list=None):
+        """
+        逐页搜索文件
+        """
+        url = 'https://api.aliyundrive.com/v2/file/search'
+        if not raw:
+            query = f'name match \"{query}\"'
+        if category_list:
+            for i in category_list:
+                if query:
+                    query += ' and '
+                query += f'category = \"{i}\"'
+        while True:
+            json = {'drive_id': await self.get_drive_id(), 'query': query, 'order_by': 'updated_at DESC',
+                    'limit': limit_num}
+            if next_marker:
+                json['marker'] = next_marker
+            data = (await self.post(url, json=json)).json()
+            if 'items' not in data:
+                return
+            for item in data['items']:
+                yield item
+            if not data.get('next_marker') or next_marker == data['next_marker'] or limit:
+                return
+            next_marker = data['next_marker']
+
+    async def get_download_url(self, file_id, expire_sec=14400) -> str:
+        """
+        获取下载链接
+        :param file_id:
+        :param expire_sec: 链接过期时间（秒）
+        :return:
+        """
+        url = 'https://api.aliyundrive.com/v2/file/get_download_url'
+        json = {'drive_id': await self.get_drive_id(), 'file_id': file_id, 'expire_sec': expire_sec}
+        logger.info(f'Get file {file_id} download link, expiration time {expire_sec} seconds.')
+        data = (await self.post(url, json=json)).json()
+        return data.get('url') or data.get('internal_url') or ''
+
+    async def batch_request(self, request_list: list, url: str = 'https://api.aliyundrive.com/v2/batch',
+                            headers: dict = None, retry_num: int = 3) -> dict:
+        """
+        按batch接口的数量限制分块并发请求，只重试失败的子请求
+        :return: {子请求id: 子响应}，请求失败时子响应为None
+        """
+        batch_size = self._disk._batch_size
+        result = {i['id']: None for i in request_list}
+        pending = request_list
+        while pending and retry_num:
+            chunk_list = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+            for response_list in await asyncio.gather(*[self._batch_chunk(i, url, headers) for i in chunk_list]):
+                for response in response_list:
+                    if response.get('id') in result:
+                        result[response['id']] = response
+            pending = [i for i in pending if AliyunPan._batch_retryable(result[i['id']])]
+            retry_num -= 1
+        return result
+
+    async def _batch_chunk(self, request_list, url, headers):
+        try:
+            r = await self.post(url, json={'requests': request_list, 'resource': 'file'}, headers=headers)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.exception('Batch request failed.')
+            return []
+        if r.status_code != 200:
+            return []
+        return r.json().get('responses', [])
+
+    async def batch(self, file_id_list: list, parent_file_id: str, force: bool = False) -> dict:
+        """
+        移动文件，分享模式下为保存文件
+        :return: {file_id: 子响应}
+        """
+        drive_id = await self.get_drive_id()
+        share = self._disk.share
+        request_list = []
+        headers = {}
+        for file_id in dict.fromkeys(file_id_list):
+            body = {'file_id': file_id, 'to_parent_file_id': parent_file_id, 'auto_rename': not force}
+            request_list.append({'body': body, 'headers': {'Content-Type': 'application/json'}, 'id': file_id,
+                                 'method': 'POST', 'url': '/file/move'})
+        if share.share_id:
+            url = 'https://api.aliyundrive.com/adrive/v2/batch'
+            for file_json in request_list:
+                file_json['body'].update({'to_drive_id': drive_id, 'share_id': share.share_id})
+                file_json['url'] = '/file/copy'
+            headers['x-share-token'] = await self._run(self._disk.get_share_token)
+        else:
+            url = 'https://api.aliyundrive.com/v2/batch'
+            for file_json in request_list:
+                file_json['body']['drive_id'] = drive_id
+        return await self.batch_request(request_list, url, headers)
+
+    async def move_file(self, file_list: list, parent_file_id: str) -> list:
+        """
+        移动文件，失败的文件file_id置为None，成功的文件new_file_id为移动或复制后的id
+        :return: 移动成功的文件
+        """
+        result = await self.batch([i.file_id for i in file_list], parent_file_id)
+        moved_list = []
+        for file in file_list:
+            response = result.get(file.file_id)
+            if AliyunPan.batch_ok(response):
+                file.new_file_id = (response.get('body') or {}).get('file_id', file.file_id)
+                moved_list.append(file)
+            else:
+                file.file_id = None
+        return moved_list
+
+    async def delete_files(self, file_id_list: list) -> dict:
+        """
+        批量删除文件
+        :return: {file_id: 是否删除成功}
+        """
+        drive_id = await self.get_drive_id()
+        request_list = [{'body': {'drive_id': drive_id, 'file_id': file_id},
+                         'headers': {'Content-Type': 'application/json'},
+                         'id': file_id, 'method': 'POST',
+                         'url': '/recyclebin/trash'} for file_id in dict.fromkeys(file_id_list)]
+        result = await self.batch_request(request_list)
+        return {file_id: AliyunPan.batch_ok(response) for file_id, response in result.items()}
+
+    async def create_file(self, file_name: str, parent_file_id: str = 'root', file_type: bool = False,
+                          json: dict = None, force: bool = False) -> AsyncResponse:
+        """
+        创建文件
+        """
+        j = {'name': file_name, 'drive_id': await self.get_drive_id(), 'parent_file_id': parent_file_id,
+             'content_hash_name': 'sha1', 'type': 'file' if file_type else 'folder',
+             'check_name_mode': 'auto_rename' if file_type and not force else 'refuse'}
+        if json:
+            j.update(json)
+        url = 'https://api.aliyundrive.com/adrive/v2/file/createWithFolders'
+        logger.info(f'Create file {file_name} in file {parent_file_id}.')
+        r = await self.post(url, json=j)
+        if force and 'exist' in r.json():
+            await self.delete_files([r.json()['file_id']])
+            return await self.create_file(file_name, parent_file_id, file_type, json)
+        return r
+
+    async def get_upload_url(self, upload_id: str, file_id: str, part_count: int) -> list:
+        url = 'https://api.aliyundrive.com/v2/file/get_upload_url'
+        json = {'drive_id': await self.get_drive_id(), 'file_id': file_id, 'upload_id': upload_id,
+                'part_info_list': [{'part_number': i + 1} for i in range(part_count)]}
+        r = await self.post(url, json=json)
+        if r.json().get('code') == AliyunpanCode.existed:
+            raise FileExistsError
+        return r.json().get('part_info_list', [])
+
+    async def complete(self, file_id, upload_id):
+        url = 'https://api.aliyundrive.com/v2/file/complete'
+        json = {'ignoreError': True, 'drive_id': await self.get_drive_id(), 'file_id': file_id,
+                'upload_id': upload_id}
+        r = await self.post(url, json=json)
+        if r.json().get('code') == AliyunpanCode.invalid_content_hash:
+            raise InvalidContentHash
+        if r.status_code == 200:
+            return r.json()
+        return False
+
+    async def upload_file(self, parent_file_id: str = 'root', path: str = None, force: bool = False,
+                          chunk_size: int = None, parallel: int = 4, upload_timeout: float = 60):
+        """
+        上传文件
+        :param parent_file_id: 上传目录的id
+        :param path: 上传文件路径
+        :param force: 强制覆盖
+        :param chunk_size: 分块大小，为空时根据文件大小和上传速度自动选择
+        :param parallel: 并发上传的分块数
+        :param upload_timeout: 分块上传超时时间
+        :return: 秒传时返回file_id，否则返回complete的结果
+        """
+        if not parent_file_id:
+            raise InvalidParentFileId
+        path = Path(path)
+        file_size = path.stat().st_size
+        chunk_size = chunk_size or self._disk.get_part_size(file_size, parallel)
+        part_count = int(file_size / chunk_size) + 1
+        if part_count > self._disk._max_part_num:
+            raise PartNumberOverLimit
+        access_token = await self.get_access_token()
+        content_hash, proof_bytes = await self._run(get_sha1_proof, path, access_token)
+        json = {'size': file_size, 'part_info_list': [{'part_number': i + 1} for i in range(part_count)],
+                'content_hash': content_hash, 'proof_code': get_proof_code(proof_bytes), 'proof_version': 'v1'}
+        r = await self.create_file(path.name, parent_file_id, file_type=True, json=json, force=force)
+        data = r.json()
+        if 'rapid_upload' not in data:
+            logger.error(data.get('message'))
+            raise AliyunpanException(data.get('message'))
+        if data['rapid_upload']:
+            logger.info(f'Rapid upload {path}.')
+            return data['file_id']
+        upload_id, file_id = data['upload_id'], data['file_id']
+        part_info_list = {i['part_number']: i['upload_url'] for i in data['part_info_list']}
+        # 分块需要按顺序提交，每个分块完成后通知后面的分块
+        done_events = {i: asyncio.Event() for i in part_info_list}
+        semaphore = asyncio.Semaphore(max(int(parallel or 1), 1))
+        with FileMap(path) as file_map:
+            tasks = [asyncio.ensure_future(
+                self._upload_part(file_map, part_info_list, part_number, chunk_size, upload_id, file_id, done_events,
+                                  semaphore, upload_timeout)) for part_number in part_info_list]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    # 抛出失败分块的异常
+                    task.result()
+            finally:
+                # 离开FileMap前取消并等待其余分块，避免读取已关闭的文件映射
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        return await self.complete(file_id, upload_id)
+
+    @staticmethod
+    async def _iter_window(window):
+        for chunk in window:
+            yield chunk
+
+    async def _upload_part(self, file_map, part_info_list, part_number, chunk_size, upload_id, file_id,
+                           done_events, semaphore, upload_timeout):
+        """
+        上传单个分块，成功后通知后面的分块
+        """
+        offset = (part_number - 1) * chunk_size
+        size = len(file_map.window(offset, chunk_size))
+        retry_count = 0
+        not_sequential_count = 0
+        while size:
+            upload_url = part_info_list[part_number]
+            try:
+                async with semaphore:
+                    # 分块从文件中流式读取
+                    data = self._iter_window(file_map.window(offset, chunk_size))
+                    r = await self.request('PUT', upload_url, access_token=False, data=data,
+                                           headers={'Content-Length': str(size)},
+                                           timeout=aiohttp.ClientTimeout(total=upload_timeout))
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if retry_count >= self._retry_num:
+                    raise
+                retry_count += 1
+                logger.warning('Upload timeout.')
+                await asyncio.sleep(1)
+                continue
+            if r.status_code in (200, AliyunpanCode.part_already_exist):
+                break
+            elif r.status_code == AliyunpanCode.request_expired:
+                logger.warning(f'Part {part_number} upload request has expired.')
+                await self._refresh_upload_url(part_info_list, upload_url, upload_id, file_id)
+            elif r.status_code == AliyunpanCode.part_not_sequential and part_number - 1 in done_events and \
+                    not_sequential_count < self._disk._not_sequential_retry:
+                not_sequential_count += 1
+                # 等待前一个分块上传完成
+                await done_events[part_number - 1].wait()
+                await asyncio.sleep(self._disk.not_sequential_delay(not_sequential_count))
+            else:
+                logger.error(r.status_code)
+                raise AliyunpanException(f'Upload part {part_number} failed with {r.status_code}.')
+        done_events[part_number].set()
+
+    async def _refresh_upload_url(self, part_info_list, upload_url, upload_id, file_id):
+        async with self._upload_url_lock:
+            # 其他分块已经刷新
+            if upload_url not in part_info_list.values():
+                return
+            new_part_info_list = await self.get_upload_url(upload_id, file_id, len(part_info_list))
+            if not new_part_info_list:
+                raise UploadUrlFailedRefresh
+            part_info_list.update({i['part_number']: i['upload_url'] for i in new_part_info_list})
+
+    async def get_user_info(self):
+        return await self._run(self._disk.get_user_info)
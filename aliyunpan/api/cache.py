@@ -0,0 +1,482 @@
+import json
+import os
+import sqlite3
+import time
+from collections.abc import MutableMapping
+from threading import RLock
+
+from aliyunpan.api.utils import ROOT_DIR, logger
+from aliyunpan.common import DATA
+
+__all__ = ['cache_file', 'task_file', 'Cache', 'HashCache', 'TreeCache', 'UrlCache', 'SpeedCache', 'TaskInfo',
+           'TaskJournal']
+
+cache_file = ROOT_DIR + os.sep + 'cache.db'
+task_file = ROOT_DIR + os.sep + 'tasks.db'
+
+
+class Cache:
+    """
+    本地sqlite缓存，出错时自动停用，不影响正常功能
+    """
+    _table = None
+    _schema = None
+
+    def __init__(self, db_file=None):
+        self._db_file = db_file or cache_file
+        self._conn = None
+        self._lock = RLock()
+        self.enable = True
+
+    def _connect(self):
+        if not self._conn:
+            self._conn = sqlite3.connect(self._db_file, check_same_thread=False, timeout=10)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.executescript(self._schema)
+            self._conn.commit()
+        return self._conn
+
+    def execute(self, sql, *args, commit=False, many=False):
+        if not self.enable:
+            return []
+        with self._lock:
+            try:
+                conn = self._connect()
+                cursor = conn.executemany(sql, *args) if many else conn.execute(sql, *args)
+                result = cursor.fetchall()
+                if commit:
+                    conn.commit()
+                return result
+            except sqlite3.Error:
+                logger.exception(f'Cache {self._db_file} is not available.')
+                self.enable = False
+                return []
+
+    def evict(self, max_size, order_by):
+        """
+        超出容量时删除最旧的记录
+        """
+        count = self.execute(f'SELECT COUNT(*) FROM {self._table}')
+        if count and count[0][0] > max_size:
+            self.execute(f'DELETE FROM {self._table} WHERE rowid IN '
+                         f'(SELECT rowid FROM {self._table} ORDER BY {order_by} LIMIT ?)',
+                         (count[0][0] - max_size,), commit=True)
+
+    def clear(self):
+        self.execute(f'DELETE FROM {self._table}', commit=True)
+
+    def close(self):
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
+
+
+class HashCache(Cache):
+    """
+    文件sha1缓存，以(device, inode, size, mtime_ns)为键
+    """
+    _instance = None
+    _first_init = True
+    _table = 'file_hash'
+    _schema = 'CREATE TABLE IF NOT EXISTS file_hash (device INTEGER, inode INTEGER, size INTEGER, ' \
+              'mtime_ns INTEGER, sha1 TEXT, path TEXT, access_time REAL, ' \
+              'PRIMARY KEY (device, inode, size, mtime_ns))'
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, db_file=None, max_size=200000):
+        if not self._first_init:
+            return
+        self._first_init = False
+        super(HashCache, self).__init__(db_file)
+        self.max_size = max_size
+        self.rehash = False
+        # 更新访问时间的最小间隔
+        self.touch_interval = 86400
+        self._count = 0
+
+    @staticmethod
+    def _key(stat):
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, path, stat=None):
+        if self.rehash:
+            return None
+        stat = stat or os.stat(path)
+        key = self._key(stat)
+        result = self.execute('SELECT sha1, access_time FROM file_hash '
+                              'WHERE device=? AND inode=? AND size=? AND mtime_ns=?', key)
+        if not result:
+            return None
+        # 访问时间只用于淘汰，超过一定时间才更新，避免每次命中都写入
+        now = time.time()
+        if now - (result[0][1] or 0) > self.touch_interval:
+            self.execute('UPDATE file_hash SET access_time=? WHERE device=? AND inode=? AND size=? AND mtime_ns=?',
+                         (now, *key), commit=True)
+        logger.debug(f'Hit hash cache of {path}.')
+        return result[0][0]
+
+    def set(self, path, sha1, stat=None):
+        stat = stat or os.stat(path)
+        self.execute('INSERT OR REPLACE INTO file_hash VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (*self._key(stat), sha1.lower(), str(path), time.time()), commit=True)
+        self._count += 1
+        if self._count % 1000 == 1:
+            self.evict(self.max_size, 'access_time')
+
+
+class TreeCache(Cache):
+    """
+    云盘目录树缓存，按文件夹保存子文件列表
+    """
+    _table = 'folder'
+    _schema = 'CREATE TABLE IF NOT EXISTS folder (drive_id TEXT, file_id TEXT, list_time REAL, ' \
+              'PRIMARY KEY (drive_id, file_id));' \
+              'CREATE TABLE IF NOT EXISTS file_tree (drive_id TEXT, file_id TEXT, parent_file_id TEXT, info TEXT, ' \
+              'PRIMARY KEY (drive_id, file_id));' \
+              'CREATE INDEX IF NOT EXISTS file_tree_parent ON file_tree (drive_id, parent_file_id);'
+    # 会过期的字段不缓存
+    _volatile_keys = ('download_url', 'url', 'thumbnail')
+
+    def __init__(self, db_file=None, max_size=20000):
+        super(TreeCache, self).__init__(db_file)
+        self.max_size = max_size
+
+    def load(self, drive_id):
+        """
+        :return: (文件信息列表, {文件夹id: 获取列表的时间})
+        """
+        file_list = [json.loads(i[0]) for i in
+                     self.execute('SELECT info FROM file_tree WHERE drive_id=?', (drive_id,))]
+        folders = dict(self.execute('SELECT file_id, list_time FROM folder WHERE drive_id=?', (drive_id,)))
+        return file_list, folders
+
+    def save_folder(self, drive_id, file_id, file_list, list_time=None):
+        rows = []
+        for info in file_list:
+            info = {k: v for k, v in info.items() if k not in self._volatile_keys}
+            rows.append((drive_id, info['file_id'], file_id, json.dumps(info, ensure_ascii=False)))
+        self.execute('DELETE FROM file_tree WHERE drive_id=? AND parent_file_id=?', (drive_id, file_id))
+        self.execute('INSERT OR REPLACE INTO file_tree VALUES (?, ?, ?, ?)', rows, many=True)
+        self.execute('INSERT OR REPLACE INTO folder VALUES (?, ?, ?)', (drive_id, file_id, list_time or time.time()),
+                     commit=True)
+        self.evict(self.max_size, 'list_time')
+
+    def invalidate(self, drive_id, file_id):
+        self.execute('DELETE FROM folder WHERE drive_id=? AND file_id=?', (drive_id, file_id), commit=True)
+
+    def evict(self, max_size, order_by):
+        count = self.execute('SELECT COUNT(*) FROM folder')
+        if count and count[0][0] > max_size:
+            evicted = self.execute(f'SELECT drive_id, file_id FROM folder ORDER BY {order_by} LIMIT ?',
+                                   (count[0][0] - max_size,))
+            self.execute('DELETE FROM file_tree WHERE drive_id=? AND parent_file_id=?', evicted, many=True)
+            self.execute('DELETE FROM folder WHERE drive_id=? AND file_id=?', evicted, many=True, commit=True)
+
+    def clear(self):
+        self.execute('DELETE FROM file_tree')
+        super(TreeCache, self).clear()
+
+
+class UrlCache(Cache):
+    """
+    下载链接缓存，以(drive_id, file_id)为键，按响应中的过期时间失效
+    """
+    _instance = None
+    _first_init = True
+    _table = 'download_url'
+    _schema = 'CREATE TABLE IF NOT EXISTS download_url (drive_id TEXT, file_id TEXT, url TEXT, expire_time REAL, ' \
+              'PRIMARY KEY (drive_id, file_id))'
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, db_file=None, max_size=100000, margin=300):
+        if not self._first_init:
+            return
+        self._first_init = False
+        super(UrlCache, self).__init__(db_file)
+        self.max_size = max_size
+        # 链接过期前提前失效的时间
+        self.margin = margin
+        # 是否保存到本地，否则只在内存中缓存
+        self.persist = False
+        self._urls = {}
+
+    def get(self, drive_id, file_id, min_expire_sec=0):
+        """
+        :param drive_id:
+        :param file_id:
+        :param min_expire_sec: 需要的最短有效时间，剩余有效时间不足时不使用缓存
+        :return:
+        """
+        key = (drive_id, file_id)
+        with self._lock:
+            entry = self._urls.get(key)
+            if not entry and self.persist:
+                result = self.execute('SELECT url, expire_time FROM download_url WHERE drive_id=? AND file_id=?', key)
+                if result:
+                    entry = self._urls[key] = tuple(result[0])
+            if not entry:
+                return None
+            remaining = entry[1] - time.time()
+            if remaining <= self.margin:
+                self._urls.pop(key, None)
+                return None
+        if remaining < min_expire_sec - min(self.margin, min_expire_sec / 2):
+            return None
+        logger.debug(f'Hit download url cache of {file_id}.')
+        return entry[0]
+
+    def set(self, drive_id, file_id, url, expire_sec, expire_time=None):
+        self.set_many(drive_id, [(file_id, url)], expire_sec, expire_time)
+
+    def set_many(self, drive_id, url_list, expire_sec, expire_time=None):
+        """
+        :param drive_id:
+        :param url_list: [(file_id, url)]
+        :param expire_sec: 请求的链接有效时间
+        :param expire_time: 响应中链接的过期时间戳，为空时根据expire_sec计算
+        """
+        now = time.time()
+        expire_time = expire_time or now + expire_sec
+        rows = [(drive_id, file_id, url, expire_time) for file_id, url in url_list if url]
+        if not rows:
+            return
+        with self._lock:
+            for row in rows:
+                self._urls[row[:2]] = row[2:]
+            if len(self._urls) > self.max_size:
+                self._urls = {k: v for k, v in self._urls.items() if v[1] - self.margin > now}
+            if self.persist:
+                self.execute('INSERT OR REPLACE INTO download_url VALUES (?, ?, ?, ?)', rows, many=True)
+                self.execute('DELETE FROM download_url WHERE expire_time<=?', (now + self.margin,), commit=True)
+
+    def invalidate(self, drive_id, file_id):
+        with self._lock:
+            self._urls.pop((drive_id, file_id), None)
+            if self.persist:
+                self.execute('DELETE FROM download_url WHERE drive_id=? AND file_id=?', (drive_id, file_id),
+                             commit=True)
+
+    def clear(self):
+        with self._lock:
+            self._urls.clear()
+            super(UrlCache, self).clear()
+
+
+class SpeedCache(Cache):
+    """
+    最近测得的传输速度(单个连接，字节/秒)，按指数加权平均更新
+    """
+    _instance = None
+    _first_init = True
+    _table = 'transfer_speed'
+    _schema = 'CREATE TABLE IF NOT EXISTS transfer_speed (kind TEXT PRIMARY KEY, speed REAL, update_time REAL)'
+
+    def __new__(cls, *args, **kwargs):
+        if not cls._instance:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, db_file=None, alpha=0.3, min_size=1048576, ttl=7 * 24 * 3600):
+        if not self._first_init:
+            return
+        self._first_init = False
+        super(SpeedCache, self).__init__(db_file)
+        self.alpha = alpha
+        # 传输量太小时测得的速度不准确
+        self.min_size = min_size
+        self.ttl = ttl
+        self._speed = {}
+
+    def get(self, kind):
+        if kind not in self._speed:
+            result = self.execute('SELECT speed FROM transfer_speed WHERE kind=? AND update_time>?',
+                                  (kind, time.time() - self.ttl))
+            self._speed[kind] = result[0][0] if result else None
+        return self._speed[kind]
+
+    def update(self, kind, size, seconds, connections=1):
+        """
+        :param kind: upload或download
+        :param size: 传输的字节数
+        :param seconds: 用时
+        :param connections: 并发连接数
+        """
+        if size < self.min_size or seconds <= 0:
+            return
+        speed = size / seconds / max(connections, 1)
+        with self._lock:
+            old = self.get(kind)
+            self._speed[kind] = speed if not old else old + self.alpha * (speed - old)
+            logger.debug(f'Measured {kind} speed: {speed:.0f}B/s, average: {self._speed[kind]:.0f}B/s.')
+            self.execute('INSERT OR REPLACE INTO transfer_speed VALUES (?, ?, ?)', (kind, self._speed[kind], time.time()),
+                         commit=True)
+
+
+class TaskInfo(DATA):
+    """
+    上传任务，修改字段时写入任务日志
+    """
+
+    def __init__(self, seq=None, journal=None, key=None):
+        dict.__init__(self, seq or {})
+        for field, value in self.items():
+            if isinstance(value, dict):
+                dict.__setitem__(self, field, DATA(value))
+        object.__setattr__(self, '_journal', journal)
+        object.__setattr__(self, '_key', key)
+
+    def __setitem__(self, key, value):
+        super(TaskInfo, self).__setitem__(key, value)
+        if self.__dict__.get('_journal'):
+            self._journal.log(self._key, key, value)
+
+    def __delitem__(self, key):
+        super(TaskInfo, self).__delitem__(key)
+        if self.__dict__.get('_journal'):
+            self._journal.log(self._key, key, delete=True)
+
+
+class TaskJournal(Cache, MutableMapping):
+    """
+    上传任务日志，每次修改立即追加一条记录，程序被强制结束也不会丢失进度
+    加载时在快照上回放日志，日志过多时合并到快照
+    """
+    _table = 'task_log'
+    _schema = 'CREATE TABLE IF NOT EXISTS task (key TEXT PRIMARY KEY, data TEXT); ' \
+              'CREATE TABLE IF NOT EXISTS task_log (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, field TEXT, ' \
+              'value TEXT)'
+
+    def __init__(self, db_file=None, compact_size=10000):
+        super(TaskJournal, self).__init__(db_file or task_file)
+        self.compact_size = compact_size
+        self._tasks = {}
+        self._log_count = 0
+        self.load()
+
+    def _connect(self):
+        if not self._conn:
+            super(TaskJournal, self)._connect()
+            # WAL模式下NORMAL已能保证程序崩溃时不丢失已提交的记录
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+        return self._conn
+
+    def load(self):
+        with self._lock:
+            # 快照中的任务在第一次访问时才解析
+            self._tasks = dict(self.execute('SELECT key, data FROM task'))
+            log_list = self.execute('SELECT key, field, value FROM task_log ORDER BY id')
+            for key, field, value in log_list:
+                self._apply(key, field, value)
+            self._log_count = len(log_list)
+        logger.debug(f'Load {len(self._tasks)} tasks and {self._log_count} logs.')
+
+    def _apply(self, key, field, value):
+        if field is None:
+            if value is None:
+                self._tasks.pop(key, None)
+            else:
+                self._tasks[key] = TaskInfo(json.loads(value), self, key)
+        elif key in self._tasks:
+            task = self[key]
+            if value is None:
+                dict.pop(task, field, None)
+            else:
+                dict.__setitem__(task, field, json.loads(value))
+
+    def log(self, key, field=None, value=None, delete=False):
+        """
+        追加一条记录
+        :param key: 任务键
+        :param field: 字段，为空时表示整个任务
+        :param value:
+        :param delete: 删除字段或任务
+        """
+        value = None if delete else json.dumps(value.to_dict() if isinstance(value, DATA) else value,
+                                               ensure_ascii=False)
+        with self._lock:
+            self.execute('INSERT INTO task_log (key, field, value) VALUES (?, ?, ?)', (key, field, value), commit=True)
+            self._log_count += 1
+            if self._log_count >= self.compact_size:
+                self.compact()
+
+    def compact(self):
+        """
+        把日志涉及的任务写入快照，然后清空日志
+        """
+        with self._lock:
+            if not self._log_count or not self.enable:
+                return
+            key_list = [i[0] for i in self.execute('SELECT DISTINCT key FROM task_log')]
+            self.execute('DELETE FROM task WHERE key=?', [(key,) for key in key_list], many=True)
+            self.execute('INSERT INTO task VALUES (?, ?)',
+                         [(key, self._dumps(self._tasks[key])) for key in key_list if key in self._tasks], many=True)
+            self.execute('DELETE FROM task_log', commit=True)
+            logger.debug(f'Compact {self._log_count} logs of {len(key_list)} tasks.')
+            self._log_count = 0
+
+    def migrate(self, tasks):
+        """
+        导入旧版本tasks.yaml中的任务
+        """
+        with self._lock:
+            task_list = [(key, TaskInfo(task, self, key)) for key, task in tasks.items() if key not in self._tasks]
+            self.execute('INSERT OR REPLACE INTO task VALUES (?, ?)',
+                         [(key, self._dumps(task)) for key, task in task_list], many=True, commit=True)
+            self._tasks.update(task_list)
+        logger.info(f'Migrate {len(task_list)} tasks.')
+        return self.enable
+
+    @staticmethod
+    def _dumps(task):
+        if isinstance(task, str):
+            return task
+        return json.dumps(task.to_dict(), ensure_ascii=False)
+
+    def __getitem__(self, key):
+        task = self._tasks[key]
+        if isinstance(task, str):
+            with self._lock:
+                task = self._tasks[key]
+                if isinstance(task, str):
+                    task = self._tasks[key] = TaskInfo(json.loads(task), self, key)
+        return task
+
+    def __setitem__(self, key, value):
+        task = TaskInfo(value, self, key)
+        with self._lock:
+            self._tasks[key] = task
+            self.log(key, value=task)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._tasks[key]
+            self.log(key, delete=True)
+
+    def __iter__(self):
+        return iter(list(self._tasks))
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __contains__(self, key):
+        return key in self._tasks
+
+    def clear(self):
+        with self._lock:
+            self._tasks.clear()
+            self.execute('DELETE FROM task')
+            self.execute('DELETE FROM task_log', commit=True)
+            self._log_count = 0
+
+    def close(self):
+        self.compact()
+        super(TaskJournal, self).close()
@@ -1,15 +1,18 @@
+import calendar
 import sys
 import time
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from threading import RLock
+from threading import RLock, Condition
 from typing import List
 
 import requests
 import simplejson
 
 # from aliyunpan.api import ua
+from aliyunpan.api.cache import HashCache, UrlCache, SpeedCache
 from aliyunpan.api.req import *
 from aliyunpan.api.type import UserInfo, AlibumInfo, Share, File
 from aliyunpan.api.utils import *
@@ -35,17 +38,31 @@ class AliyunPan(object):
         self._password = None
         self._refresh_token = refresh_token
         self._refresh_token_expires = None
-        self._access_token_gen_ = self._access_token_gen()
+        # access_token过期前提前刷新的时间
+        self._token_refresh_margin = 600
         self._drive_id_gen_ = self._drive_id_gen()
         self._chunk_size = 524288
+        # 自动选择分块大小时的上限、单个分块的目标上传时间和分块数量上限
+        self._max_chunk_size = 268435456
+        self._part_time = 4
+        self._max_part_num = 10000
+        self._pre_hash_size = 1024
+        # 分块不连续时等待前面的分块后重试的次数，重试间隔逐渐增加
+        self._not_sequential_retry = 3
+        # batch接口单次最多的子请求数
+        self._batch_size = 100
+        self._batch_workers = 4
+        # 获取文件列表时同时获取的下载链接有效时间
+        self._url_expire_sec = 14400
         self._print = Printer()
         self._lock = RLock()
 
     refresh_token = property(lambda self: self._refresh_token,
                              lambda self, value: setattr(self, '_refresh_token', value))
-    access_token = property(lambda self: (self._lock.acquire(), next(self._access_token_gen_), self._lock.release())[1],
+    access_token = property(lambda self: self._get_access_token(),
                             lambda self, value: setattr(self, '_access_token', value))
-    drive_id = property(lambda self: (self._lock.acquire(), next(self._drive_id_gen_), self._lock.release())[1],
+    drive_id = property(lambda self: self._drive_id or (self._lock.acquire(), next(self._drive_id_gen_),
+                                                        self._lock.release())[1],
                         lambda self, value: setattr(self, '_drive_id', value))
     album = property(lambda self: self._album, lambda self, value: setattr(self, '_album', value))
     share = property(lambda self: self._share)
@@ -105,35 +122,68 @@ class AliyunPan(object):
         获取文件列表
         :param parent_file_id:
         :param next_marker:
-        :return:
+        :return: 获取失败时返回None，空文件夹返回空列表
+        """
+        file_list = []
+        iterator = self.iter_file_list(parent_file_id, next_marker, retry)
+        while True:
+            try:
+                file_list.append(next(iterator))
+            except StopIteration as e:
+                # iter_file_list在获取失败时返回False
+                return None if e.value is False else file_list
+
+    def iter_file_list(self, parent_file_id: str = 'root', next_marker: str = None, retry=3):
+        """
+        逐页获取文件列表
+        :param parent_file_id:
+        :param next_marker:
+        :param retry: 每页解析失败的重试次数
+        :return: 生成文件信息，获取失败时生成器返回False
         """
-        json = {"parent_file_id": parent_file_id}
-        if next_marker:
-            json['marker'] = next_marker
-        headers = {}
-        kwargs = {}
         url = 'https://api.aliyundrive.com/adrive/v3/file/list'
-        if self._share.share_id:
-            json.update({'share_id': self._share.share_id, 'share_pwd': self._share.share_pwd})
-            headers = {'x-share-token': self.get_share_token()}
-            kwargs = {'access_token': None}
-        else:
-            json.update({"drive_id": self.drive_id, 'fields': '*'})
-        logger.info(f'Get the list of parent_file_id {parent_file_id}.')
-        r = self._req.post(url, json=json, headers=headers, **kwargs)
-        try:
-            logger.debug(r.json())
-        except simplejson.errors.JSONDecodeError:
-            if retry:
-                return self.get_file_list(parent_file_id=parent_file_id, next_marker=next_marker, retry=retry - 1)
+        retry_count = retry
+        while True:
+            json = {"parent_file_id": parent_file_id}
+            if next_marker:
+                json['marker'] = next_marker
+            headers = {}
+            kwargs = {}
+            if self._share.share_id:
+                json.update({'share_id': self._share.share_id, 'share_pwd': self._share.share_pwd})
+                headers = {'x-share-token': self.get_share_token()}
+                kwargs = {'access_token': None}
             else:
+                json.update({"drive_id": self.drive_id, 'fields': '*', 'url_expire_sec': self._url_expire_sec})
+            logger.info(f'Get the list of parent_file_id {parent_file_id}.')
+            r = self._req.post(url, json=json, headers=headers, **kwargs)
+            try:
+                data = r.json()
+            except simplejson.errors.JSONDecodeError:
+                if retry_count:
+                    retry_count -= 1
+                    continue
                 raise
-        if 'items' not in r.json():
-            return []
-        file_list = r.json()['items']
-        if 'next_marker' in r.json() and r.json()['next_marker'] and next_marker != r.json()['next_marker']:
-            file_list.extend(self.get_file_list(parent_file_id, r.json()['next_marker']))
-        return file_list
+            logger.debug(data)
+            retry_count = retry
+            if 'items' not in data:
+                return False
+            if not self._share.share_id:
+                UrlCache().set_many(self.drive_id, [(i['file_id'], i.get('download_url')) for i in data['items']
+                                                    if i.get('download_url') != self._illegal_url],
+                                    self._url_expire_sec)
+            yield from data['items']
+            if not data.get('next_marker') or next_marker == data['next_marker']:
+                return
+            next_marker = data['next_marker']
+
+    def prefetch_download_urls(self, parent_file_id: str = 'root'):
+        """
+        获取文件夹下所有文件的下载链接并缓存
+        :param parent_file_id:
+        :return: 文件数量
+        """
+        return sum(1 for i in self.iter_file_list(parent_file_id) if i['type'] == 'file')
 
     def delete_file(self, file_id: str):
         """
@@ -141,65 +191,113 @@ class AliyunPan(object):
         :param file_id:
         :return:
         """
-        url = 'https://api.aliyundrive.com/v2/batch'
-        json = {'requests': [{'body': {'drive_id': self.drive_id, 'file_id': file_id},
-                              'headers': {'Content-Type': 'application/json'},
-                              'id': file_id, 'method': 'POST',
-                              'url': '/recyclebin/trash'}], 'resource': 'file'}
-        logger.info(f'Delete file {file_id}.')
-        r = self._req.post(url, json=json)
-        logger.debug(r.text)
-        if r.status_code == 200:
-            return r.json()['responses'][0]['id']
+        if self.delete_files([file_id]).get(file_id):
+            return file_id
         return False
 
-    def batch(self, file_id_list: list, parent_file_id: str, force: bool = False) -> requests.models.Response:
+    def delete_files(self, file_id_list: list) -> dict:
+        """
+        批量删除文件
+        :param file_id_list:
+        :return: {file_id: 是否删除成功}
+        """
+        request_list = [{'body': {'drive_id': self.drive_id, 'file_id': file_id},
+                         'headers': {'Content-Type': 'application/json'},
+                         'id': file_id, 'method': 'POST',
+                         'url': '/recyclebin/trash'} for file_id in dict.fromkeys(file_id_list)]
+        logger.info(f'Delete {len(request_list)} files.')
+        result = self.batch_request(request_list)
+        return {file_id: self.batch_ok(response) for file_id, response in result.items()}
+
+    @staticmethod
+    def batch_ok(response) -> bool:
+        return bool(response) and 200 <= response.get('status', 200) < 300
+
+    @staticmethod
+    def _batch_retryable(response) -> bool:
+        return not response or response.get('status', 200) >= 500 or response.get('status') == 429
+
+    def batch_request(self, request_list: list, url: str = 'https://api.aliyundrive.com/v2/batch',
+                      headers: dict = None, retry_num: int = 3) -> dict:
+        """
+        按batch接口的数量限制分块并发请求，只重试失败的子请求
+        :param request_list: 子请求列表，id不能重复
+        :param url:
+        :param headers:
+        :param retry_num:
+        :return: {子请求id: 子响应}，请求失败时子响应为None
+        """
+        result = {i['id']: None for i in request_list}
+        pending = request_list
+        while pending and retry_num:
+            chunk_list = [pending[i:i + self._batch_size] for i in range(0, len(pending), self._batch_size)]
+            with ThreadPoolExecutor(max_workers=self._batch_workers) as executor:
+                futures = [executor.submit(self._batch_chunk, chunk, url, headers) for chunk in chunk_list]
+                for future in as_completed(futures):
+                    for response in future.result():
+                        if response.get('id') in result:
+                            result[response['id']] = response
+            pending = [i for i in pending if self._batch_retryable(result[i['id']])]
+            retry_num -= 1
+            if pending and retry_num:
+                logger.warning(f'Retry {len(pending)} failed batch requests.')
+        return result
+
+    def _batch_chunk(self, request_list, url, headers):
+        json = {'requests': request_list, 'resource': 'file'}
+        try:
+            r = self._req.post(url, json=json, headers=headers or {})
+        except requests.exceptions.RequestException:
+            logger.error(sys.exc_info())
+            return []
+        logger.debug(r.text)
+        if r.status_code != 200:
+            return []
+        return r.json().get('responses', [])
+
+    def batch(self, file_id_list: list, parent_file_id: str, force: bool = False) -> dict:
         """
-        移动文件
+        移动文件，分享模式下为保存文件
+        :return: {file_id: 子响应}
         """
-        file_json_list = []
+        request_list = []
         auto_rename = False if force else True
         headers = {}
-        for file_id in file_id_list:
+        for file_id in dict.fromkeys(file_id_list):
             body = {'file_id': file_id, 'to_parent_file_id': parent_file_id, 'auto_rename': auto_rename}
-            file_json = {'body': body,
-                         'headers': {'Content-Type': 'application/json'}, 'id': "0", 'method': 'POST',
-                         'url': '/file/move'}
-            file_json_list.append(file_json)
+            request_list.append({'body': body, 'headers': {'Content-Type': 'application/json'}, 'id': file_id,
+                                 'method': 'POST', 'url': '/file/move'})
         if self._share.share_id:
             url = 'https://api.aliyundrive.com/adrive/v2/batch'
-            for i, file_json in enumerate(file_json_list):
-                file_json_list[i]['body']['to_drive_id'] = self.drive_id
-                file_json_list[i]['body']['share_id'] = self._share.share_id
-                file_json_list[i]['url'] = '/file/copy'
-                file_json_list[i]['id'] = file_json_list[i]['body']['file_id']
+            for file_json in request_list:
+                file_json['body']['to_drive_id'] = self.drive_id
+                file_json['body']['share_id'] = self._share.share_id
+                file_json['url'] = '/file/copy'
             headers['x-share-token'] = self.get_share_token()
         else:
             url = 'https://api.aliyundrive.com/v2/batch'
-            for i, file_json in enumerate(file_json_list):
-                file_json_list[i]['id'] = file_json['body']['file_id']
-                file_json_list[i]['body']['drive_id'] = self.drive_id
-        json = {'requests': file_json_list, 'resource': "file"}
-        return self._req.post(url, json=json, headers=headers)
+            for file_json in request_list:
+                file_json['body']['drive_id'] = self.drive_id
+        return self.batch_request(request_list, url, headers)
 
     def move_file(self, file_list: List[File], parent_file_id: str) -> List[File]:
         """
-        移动文件
+        移动文件，失败的文件file_id置为None，成功的文件new_file_id为移动或复制后的id
         :param file_list:
         :param parent_file_id:
-        :return:
+        :return: 移动成功的文件
         """
-        logger.info(f'Move files {file_list} to {parent_file_id}')
-        r = self.batch([i.file_id for i in file_list], parent_file_id)
-        if r.status_code == 200:
-            for i, j in enumerate(r.json()['responses']):
-                file_id = j['id']
-                if file_id:
-                    file_list[i].file_id = file_id
-                else:
-                    del file_list[i]
-            return file_list
-        return []
+        logger.info(f'Move {len(file_list)} files to {parent_file_id}')
+        result = self.batch([i.file_id for i in file_list], parent_file_id)
+        moved_list = []
+        for file in file_list:
+            response = result.get(file.file_id)
+            if self.batch_ok(response):
+                file.new_file_id = (response.get('body') or {}).get('file_id', file.file_id)
+                moved_list.append(file)
+            else:
+                file.file_id = None
+        return moved_list
 
     def update_file(self, file_id: str, name: str):
         """
@@ -300,7 +398,7 @@ class AliyunPan(object):
 
     def upload_file(self, parent_file_id: str = 'root', path: str = None, upload_timeout: float = 10,
                     retry_num: int = 3, force: bool = False, chunk_size: int = None, c: bool = False,
-                    ignore: bool = False):
+                    ignore: bool = False, parallel: int = 1, content_hash: str = None):
         """
         上传文件
         :param parent_file_id: 上传目录的id
@@ -308,40 +406,49 @@ class AliyunPan(object):
         :param upload_timeout: 分块上传超时时间
         :param retry_num:
         :param force: 强制覆盖
-        :param chunk_size: 分块大小
+        :param chunk_size: 分块大小，为空时根据文件大小和上传速度自动选择
         :param c: 断点续传
         :param ignore: 忽略上传失败的文件
+        :param parallel: 并发上传的分块数
+        :param content_hash: 已经计算好的sha1，为空时计算
         :return:
         """
         if not parent_file_id:
             raise InvalidParentFileId
         path = Path(path)
-        file_size = path.stat().st_size
+        stat = path.stat()
+        file_size = stat.st_size
         file_name = path.name
-        self._chunk_size = chunk_size or self._chunk_size
-        # 获取sha1
+        part_size = chunk_size or self.get_part_size(file_size, parallel)
+        # 分片列表
+        part_info_list = [{'part_number': i + 1} for i in range(int(file_size / part_size) + 1)]
+        if len(part_info_list) > self._max_part_num:
+            raise PartNumberOverLimit
+        # 预哈希阶段创建的任务使用的临时任务键，上传完成后替换为sha1
+        pre_hash_key = f'pre_hash:{get_real_path(path)}'
         try:
-            content_hash = get_sha1(path, self._chunk_size)
+            pre_hash_r = None
+            # 未断点续传且没有sha1缓存时先用预哈希检测，不可能秒传时跳过计算整个文件的sha1
+            if not c and not content_hash and file_size > self._pre_hash_size and not HashCache().get(path, stat):
+                pre_hash_r = self.pre_hash_probe(path, parent_file_id, part_info_list, force)
+            if c and self._get_pre_hash_task(pre_hash_key, stat):
+                # 续传预哈希阶段中断的上传，不计算sha1
+                content_hash = pre_hash_key
+                json = None
+            elif pre_hash_r:
+                content_hash = pre_hash_key
+                json = None
+            else:
+                # 获取sha1和proof_code
+                content_hash, proof_bytes = get_sha1_proof(path, self.access_token, content_hash=content_hash)
+                proof_code = get_proof_code(proof_bytes)
+                json = {"size": file_size, "part_info_list": part_info_list, "content_hash": content_hash,
+                        'proof_code': proof_code, 'proof_version': 'v1'}
         except PermissionError:
             if not ignore:
                 self._print.upload_info(path, status=False)
                 self._print.print_line()
             return False
-        while True:
-            # 分片列表
-            part_info_list = []
-            count = int(file_size / self._chunk_size) + 1
-            for i in range(count):
-                part_info_list.append({"part_number": i + 1})
-            if len(part_info_list) > 10000:
-                if chunk_size:
-                    raise PartNumberOverLimit
-                self._chunk_size = int(file_size / 1000)
-                continue
-            break
-        proof_code = get_proof_code(get_file_byte(path, self.access_token))
-        json = {"size": file_size, "part_info_list": part_info_list, "content_hash": content_hash,
-                'proof_code': proof_code, 'proof_version': 'v1'}
         path_list = []
         existed = False
         # 已存在任务
@@ -370,46 +477,56 @@ class AliyunPan(object):
                 GLOBAL_VAR.tasks[content_hash].path = path_list[0] if len(path_list) == 1 else path_list
                 GLOBAL_VAR.file_set.add((content_hash, str(get_real_path(path))))
                 return GLOBAL_VAR.tasks[content_hash].file_id
+        resumed = False
         # 断点续传且已存在任务且云盘不存在该文件
-        if c and content_hash in GLOBAL_VAR.tasks and not existed:
+        if c and content_hash in GLOBAL_VAR.tasks and not existed and GLOBAL_VAR.tasks[content_hash].upload_id:
             upload_id = GLOBAL_VAR.tasks[content_hash].upload_id
             file_id = GLOBAL_VAR.tasks[content_hash].file_id
-            self._chunk_size = GLOBAL_VAR.tasks[content_hash].chunk_size
-            part_number = GLOBAL_VAR.tasks[content_hash].part_number
             try:
-                # 获取上传链接列表
-                part_info_list = self.get_upload_url(path, upload_id, file_id, self._chunk_size, part_number)
-                if not part_info_list:
-                    # 重新上传
-                    if str(get_real_path(path)) in path_list:
-                        # 删除未上传成功的任务
-                        del path_list[str(get_real_path(path))]
-                    GLOBAL_VAR.tasks[content_hash].path = path_list[0] if len(path_list) == 1 else path_list
-                    return self.upload_file(parent_file_id=parent_file_id, path=path, upload_timeout=upload_timeout,
-                                            retry_num=retry_num, force=force, chunk_size=self._chunk_size, c=c)
+                # 刷新上传链接并查询已上传的分块
+                resume_info_list = self.resume_upload(path, upload_id, file_id,
+                                                      GLOBAL_VAR.tasks[content_hash].chunk_size,
+                                                      GLOBAL_VAR.tasks[content_hash].part_number or 1)
             except FileExistsError:
                 # 漏网之鱼
                 self._print.upload_info(path, status=True, existed=True)
                 self._print.print_line()
+                if content_hash == pre_hash_key:
+                    # 不知道sha1，无法替换任务键，直接删除临时任务
+                    return GLOBAL_VAR.tasks.pop(content_hash).file_id
                 path_list.append(str(get_real_path(path)))
                 path_list = list(set(path_list))
                 GLOBAL_VAR.tasks[content_hash].path = path_list[0] if len(path_list) == 1 else path_list
                 GLOBAL_VAR.file_set.add((content_hash, str(get_real_path(path))))
                 return GLOBAL_VAR.tasks[content_hash].file_id
-        else:
+            if resume_info_list:
+                resumed = True
+                part_info_list = resume_info_list
+                part_size = GLOBAL_VAR.tasks[content_hash].chunk_size
+            else:
+                # 上传任务已失效，重新创建
+                logger.info(f'The upload task of {path} has expired, create a new one.')
+                if content_hash == pre_hash_key:
+                    # 临时任务没有sha1，删除后重新进行预哈希检测
+                    del GLOBAL_VAR.tasks[content_hash]
+                    return self.upload_file(parent_file_id=parent_file_id, path=path, upload_timeout=upload_timeout,
+                                            retry_num=retry_num, force=force, chunk_size=chunk_size, c=False,
+                                            ignore=ignore, parallel=parallel)
+        if not resumed:
             # 申请创建文件
-            r = self.create_file(file_name=file_name, parent_file_id=parent_file_id, file_type=True, json=json,
-                                 force=force)
+            r = pre_hash_r or self.create_file(file_name=file_name, parent_file_id=parent_file_id, file_type=True,
+                                               json=json, force=force)
             if 'rapid_upload' not in r.json():
                 message = r.json()['message']
                 logger.error(message)
                 raise AliyunpanException(message)
             task_info = {'path': str(get_real_path(path)), 'upload_id': None,
-                         'file_id': None, 'chunk_size': self._chunk_size,
-                         'part_number': None}
+                         'file_id': None, 'chunk_size': part_size,
+                         'part_number': None, 'rapid_phase': 'pre_hash' if pre_hash_r else None}
             rapid_upload = r.json()['rapid_upload']
             # 快速上传成功
             if rapid_upload:
+                task_info['rapid_phase'] = 'content_hash'
                 self._print.upload_info(path, status=True, rapid_upload=True)
                 self._print.print_line()
                 file_id = r.json()['file_id']
@@ -430,6 +547,9 @@ class AliyunPan(object):
                 task_info['upload_id'] = upload_id
                 task_info['file_id'] = file_id
                 task_info['part_number'] = 1
+                if pre_hash_r:
+                    # 续传时用于确认文件未被修改
+                    task_info.update({'size': file_size, 'mtime_ns': stat.st_mtime_ns})
                 GLOBAL_VAR.tasks[content_hash] = task_info
         upload_bar = UploadBar(size=file_size)
         upload_bar.upload_info(path)
@@ -437,75 +557,41 @@ class AliyunPan(object):
         upload_bar.update(refresh_line=False)
         logger.debug(f'upload_id: {upload_id}, file_id: {file_id}, part_info_list: {part_info_list}')
         part_info_list = Iter(part_info_list)
-        for i in part_info_list:
-            part_number, upload_url = i['part_number'], i['upload_url']
-            if not upload_url:
-                continue
-            GLOBAL_VAR.tasks[content_hash].part_number = part_number
-            # 分块读取
-            with path.open('rb') as f:
-                f.seek((part_number - 1) * self._chunk_size)
-                chunk = f.read(self._chunk_size)
-            if not chunk:
+        # 待上传的分块
+        part_number_list = [i['part_number'] for i in part_info_list if i['upload_url']]
+        if part_number_list:
+            GLOBAL_VAR.tasks[content_hash].part_number = part_number_list[0]
+        upload_state = DATA({'pending': list(part_number_list), 'done': len(part_info_list) - len(part_number_list),
+                             'total': len(part_info_list), 'condition': Condition(), 'stop': False,
+                             'chunk_size': part_size, 'limiter_list': self._req.get_limiter_list('upload')})
+        upload_size = len(part_number_list) * part_size
+        start_time = time.time()
+        while True:
+            try:
+                with FileMap(path) as file_map:
+                    self._upload_parts(file_map, path, content_hash, part_info_list, list(upload_state.pending),
+                                       upload_id, file_id, upload_timeout, retry_num, parallel, upload_state,
+                                       upload_bar)
                 break
-            size = len(chunk)
-            retry_count = 0
-            while True:
-                upload_bar.update(refresh_line=True)
-                logger.debug(
-                    f'(upload_id={upload_id}, file_id={file_id}, size={size}): Upload part of {part_number} to {upload_url}.')
-                try:
-                    # 开始上传
-                    r = self._req.put(upload_url, data=chunk, timeout=upload_timeout, access_token=False)
-                    if r.status_code == AliyunpanCode.request_expired:
-                        raise UploadUrlExpired
-                    elif r.status_code == AliyunpanCode.part_already_exist:
-                        pass
-                    elif r.status_code == AliyunpanCode.part_not_sequential:
-                        raise PartNotSequential
-                    elif r.status_code != 200:
-                        logger.error(r.status_code)
-                        raise BadResponseCode
-                    break
-                except (requests.exceptions.SSLError, requests.exceptions.ConnectionError,
-                        requests.exceptions.ReadTimeout):
-                    logger.warn('Upload timeout.')
-                    if retry_count is retry_num:
-                        self._print.error_info(f'上传超时{retry_num}次，即将重新上传', refresh_line=True)
-                        time.sleep(1)
-                        return self.upload_file(parent_file_id=parent_file_id, path=path, upload_timeout=upload_timeout,
-                                                retry_num=retry_num, force=force, chunk_size=self._chunk_size, c=c)
-                    self._print.error_info('上传超时', refresh_line=True)
-                    retry_count += 1
-                    time.sleep(1)
-                except KeyboardInterrupt:
-                    raise
-                except UploadUrlExpired:
-                    info = f'Part {part_number} upload request has expired.'
-                    logger.warning(info)
-                    self._print.error_info(info, refresh_line=True)
-                    time.sleep(1)
-                    part_info_list_ = self.get_upload_url(path=path, upload_id=upload_id, file_id=file_id,
-                                                          chunk_size=self._chunk_size)
-                    if part_info_list_:
-                        part_info_list.iter = part_info_list_
-                        part_info = [i for i in part_info_list if i['part_number'] == part_number][0]
-                        upload_url = part_info['upload_url']
-                        logger.info(f'The upload_url of Part {part_number} has been refreshed.')
-                        logger.debug(upload_url)
-                    else:
-                        logger.error(f'The upload_url of Part {part_number} failed to refresh.')
-                        raise UploadUrlFailedRefresh
-                except (BadResponseCode, PartNotSequential):
-                    raise
-                except:
-                    logger.error(sys.exc_info())
-                    exc_type, exc_value, exc_traceback = sys.exc_info()
-                    self._print.error_info(exc_type.__name__, refresh_line=True)
-                    time.sleep(1)
-                self._print.wait_info(refresh_line=True)
-            k = part_number / len(part_info_list)
-            upload_bar.update(ratio=k, refresh_line=True)
+            except requests.exceptions.RequestException:
+                self._print.error_info(f'上传超时{retry_num}次，即将继续上传', refresh_line=True)
+            # 使用原来的upload_id从第一个未上传的分块继续，不重新计算sha1和创建文件
+            try:
+                resume_info_list = self._retry_resume_upload(path, upload_id, file_id, part_size,
+                                                             GLOBAL_VAR.tasks[content_hash].part_number)
+            except FileExistsError:
+                break
+            if not resume_info_list:
+                self._print.error_info('上传任务已失效，即将重新上传', refresh_line=True)
+                return self.upload_file(parent_file_id=parent_file_id, path=path, upload_timeout=upload_timeout,
+                                        retry_num=retry_num, force=force, chunk_size=part_size, c=False,
+                                        parallel=parallel)
+            part_info_list.iter = resume_info_list
+            with upload_state.condition:
+                upload_state.pending = [i['part_number'] for i in part_info_list if i['upload_url']]
+                upload_state.done = upload_state.total - len(upload_state.pending)
+                upload_state.stop = False
+            logger.info(f'Resume uploading {path} from part {upload_state.pending[:1]}.')
         file_info = None
         try:
             file_info = self.complete(file_id, upload_id)
@@ -515,10 +601,14 @@ class AliyunPan(object):
                 if get_real_path(log_file) != get_real_path(path):
                     raise
         if file_info:
+            SpeedCache().update('upload', min(upload_size, file_size), time.time() - start_time,
+                                min(max(int(parallel or 1), 1), len(part_number_list)))
             upload_bar.upload_info(path, status=True, t=upload_bar.time, average_speed=upload_bar.average_speed,
                                    refresh_line=True)
             self._print.print_line()
             GLOBAL_VAR.tasks[content_hash].upload_time = time.time()
+            if content_hash == pre_hash_key and file_info.get('content_hash'):
+                content_hash = self._rename_pre_hash_task(path, stat, content_hash, file_info['content_hash'])
             GLOBAL_VAR.file_set.add((content_hash, str(get_real_path(path))))
             return file_info
         else:
@@ -527,6 +617,234 @@ class AliyunPan(object):
                 self._print.print_line()
             return False
 
+    def get_part_size(self, file_size: int, parallel: int = 1) -> int:
+        """
+        根据文件大小和最近测得的上传速度选择分块大小
+        :param file_size:
+        :param parallel: 并发上传的分块数
+        :return:
+        """
+        parallel = max(int(parallel or 1), 1)
+        speed = SpeedCache().get('upload')
+        if speed:
+            # 每个分块大约上传_part_time秒，减少分块请求的开销
+            part_size = speed * self._part_time
+        else:
+            part_size = file_size / 100
+        # 至少分成parallel块，保证能并发上传
+        part_size = min(part_size, file_size / parallel, self._max_chunk_size)
+        # 不超过分块数量上限
+        part_size = max(part_size, self._chunk_size, file_size / (self._max_part_num - 1))
+        # 按默认分块大小对齐
+        return int(-(-part_size // self._chunk_size) * self._chunk_size)
+
+    def pre_hash_probe(self, path: Path, parent_file_id: str, part_info_list: list,
+                       force: bool = False) -> requests.models.Response:
+        """
+        预哈希秒传检测
+        :param path:
+        :param parent_file_id:
+        :param part_info_list:
+        :param force:
+        :return: 不可能秒传时返回已创建的上传任务，可能秒传时返回None
+        """
+        json = {'size': path.stat().st_size, 'part_info_list': part_info_list, 'pre_hash': get_pre_hash(path)}
+        r = self.create_file(file_name=path.name, parent_file_id=parent_file_id, file_type=True, json=json,
+                             force=force)
+        if r.json().get('code') == AliyunpanCode.pre_hash_matched:
+            logger.info(f'The pre_hash of file {path} matched, calculate sha1 for rapid upload.')
+            return None
+        logger.info(f'The pre_hash of file {path} did not match, skip calculating sha1.')
+        return r
+
+    @staticmethod
+    def _get_pre_hash_task(task_key, stat):
+        """
+        获取可以续传的预哈希任务，文件已修改时删除该任务
+        :param task_key: 临时任务键
+        :param stat: 文件的stat
+        :return:
+        """
+        task_info = GLOBAL_VAR.tasks.get(task_key)
+        if not task_info or not task_info.get('upload_id'):
+            return None
+        if task_info.get('size') != stat.st_size or task_info.get('mtime_ns') != stat.st_mtime_ns:
+            logger.info(f'The file of task {task_key} has been modified, discard the task.')
+            del GLOBAL_VAR.tasks[task_key]
+            return None
+        return task_info
+
+    @staticmethod
+    def _rename_pre_hash_task(path, stat, task_key, content_hash):
+        """
+        上传完成后将预哈希任务键替换为服务端返回的sha1，并写入sha1缓存
+        """
+        content_hash = content_hash.lower()
+        if path.stat().st_mtime_ns == stat.st_mtime_ns:
+            HashCache().set(path, content_hash, stat)
+        task_info = GLOBAL_VAR.tasks.pop(task_key)
+        GLOBAL_VAR.tasks.setdefault(content_hash, task_info)
+        return content_hash
+
+    def _upload_parts(self, file_map, path, content_hash, part_info_list, part_number_list, upload_id, file_id,
+                      upload_timeout, retry_num, parallel, upload_state, upload_bar):
+        """
+        并发上传分块
+        """
+        args = (file_map, path, content_hash, part_info_list)
+        kwargs = {'upload_id': upload_id, 'file_id': file_id, 'upload_timeout': upload_timeout,
+                  'retry_num': retry_num, 'parallel': max(int(parallel or 1), 1), 'upload_state': upload_state,
+                  'upload_bar': upload_bar}
+        if kwargs['parallel'] == 1:
+            for part_number in part_number_list:
+                if not self._upload_part(*args, part_number, **kwargs):
+                    break
+            return
+        executor = ThreadPoolExecutor(max_workers=kwargs['parallel'])
+        futures = [executor.submit(self._upload_part, *args, part_number, **kwargs) for part_number in
+                   part_number_list]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            with upload_state.condition:
+                upload_state.stop = True
+                upload_state.condition.notify_all()
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            # 等待正在上传的分块结束
+            executor.shutdown(wait=True)
+
+    def _upload_part(self, file_map, path, content_hash, part_info_list, part_number, upload_id, file_id,
+                     upload_timeout, retry_num, parallel, upload_state, upload_bar):
+        """
+        上传单个分块
+        :return: 分块是否有数据
+        """
+        if upload_state.stop:
+            return False
+        offset = (part_number - 1) * upload_state.chunk_size
+        size = len(file_map.window(offset, upload_state.chunk_size))
+        if not size:
+            self._part_done(content_hash, part_number, upload_state, upload_bar)
+            return False
+        upload_url = [i for i in part_info_list if i['part_number'] == part_number][0]['upload_url']
+        retry_count = 0
+        throttle_count = 0
+        not_sequential_count = 0
+        while True:
+            if upload_state.stop:
+                return False
+            upload_bar.update(refresh_line=True)
+            logger.debug(
+                f'(upload_id={upload_id}, file_id={file_id}, size={size}): Upload part of {part_number} to {upload_url}.')
+            try:
+                # 开始上传，分块从文件中流式读取
+                chunk = file_map.window(offset, upload_state.chunk_size)
+                r = self._req.put(upload_url, data=self._req.throttled_data(chunk, upload_state.limiter_list),
+                                  timeout=upload_timeout, access_token=False)
+                if r.status_code == AliyunpanCode.request_expired:
+                    raise UploadUrlExpired
+                elif r.status_code == AliyunpanCode.too_many_requests:
+                    # 被限流时按Retry-After等待后重试，不计入失败次数
+                    delay = r.headers.get('Retry-After')
+                    delay = int(delay) if delay and delay.isdigit() else 2 ** min(throttle_count, 5)
+                    throttle_count += 1
+                    logger.warning(f'Part {part_number} is throttled, retry after {delay}s.')
+                    self._print.wait_info(t=max(delay, 1), refresh_line=True)
+                    continue
+                elif r.status_code == AliyunpanCode.part_already_exist:
+                    pass
+                elif r.status_code == AliyunpanCode.part_not_sequential:
+                    raise PartNotSequential
+                elif r.status_code != 200:
+                    logger.error(r.status_code)
+                    raise BadResponseCode
+                break
+            except (requests.exceptions.SSLError, requests.exceptions.ConnectionError,
+                    requests.exceptions.ReadTimeout):
+                logger.warning('Upload timeout.')
+                if retry_count is retry_num or upload_state.stop:
+                    raise
+                self._print.error_info('上传超时', refresh_line=True)
+                retry_count += 1
+                time.sleep(1)
+            except KeyboardInterrupt:
+                raise
+            except UploadUrlExpired:
+                info = f'Part {part_number} upload request has expired.'
+                logger.warning(info)
+                self._print.error_info(info, refresh_line=True)
+                time.sleep(1)
+                upload_url = self._refresh_upload_url(path, part_info_list, part_number, upload_id, file_id,
+                                                      upload_url, upload_state.chunk_size)
+            except PartNotSequential:
+                if parallel == 1 or not_sequential_count >= self._not_sequential_retry:
+                    raise
+                not_sequential_count += 1
+                logger.warning(f'Part {part_number} is not sequential, retry {not_sequential_count}.')
+                # 等待前面的分块上传完成
+                with upload_state.condition:
+                    while not upload_state.stop and upload_state.pending and upload_state.pending[0] < part_number:
+                        upload_state.condition.wait()
+                if upload_state.stop:
+                    return False
+                time.sleep(self.not_sequential_delay(not_sequential_count))
+                continue
+            except BadResponseCode:
+                raise
+            except:
+                logger.error(sys.exc_info())
+                exc_type, exc_value, exc_traceback = sys.exc_info()
+                self._print.error_info(exc_type.__name__, refresh_line=True)
+                time.sleep(1)
+            self._print.wait_info(refresh_line=True)
+        self._part_done(content_hash, part_number, upload_state, upload_bar)
+        return True
+
+    @staticmethod
+    def not_sequential_delay(count):
+        """
+        分块不连续时第count次重试前等待的时间
+        """
+        return min(2 ** (count - 1), 8)
+
+    def _refresh_upload_url(self, path, part_info_list, part_number, upload_id, file_id, upload_url, chunk_size):
+        """
+        刷新过期的上传链接
+        """
+        with self._lock:
+            part_info = [i for i in part_info_list if i['part_number'] == part_number][0]
+            # 其他线程已经刷新
+            if part_info['upload_url'] and part_info['upload_url'] != upload_url:
+                return part_info['upload_url']
+            part_info_list_ = self.get_upload_url(path=path, upload_id=upload_id, file_id=file_id,
+                                                  chunk_size=chunk_size)
+            if not part_info_list_:
+                logger.error(f'The upload_url of Part {part_number} failed to refresh.')
+                raise UploadUrlFailedRefresh
+            part_info_list.iter = part_info_list_
+            part_info = [i for i in part_info_list if i['part_number'] == part_number][0]
+            logger.info(f'The upload_url of Part {part_number} has been refreshed.')
+            logger.debug(part_info['upload_url'])
+            return part_info['upload_url']
+
+    @staticmethod
+    def _part_done(content_hash, part_number, upload_state, upload_bar):
+        """
+        记录已完成的分块，断点续传从第一个未完成的分块开始
+        """
+        with upload_state.condition:
+            upload_state.pending.remove(part_number)
+            upload_state.done += 1
+            GLOBAL_VAR.tasks[content_hash].part_number = upload_state.pending[0] if upload_state.pending \
+                else upload_state.total + 1
+            upload_state.condition.notify_all()
+            k = upload_state.done / upload_state.total
+        upload_bar.update(ratio=k, refresh_line=True)
+
     def complete(self, file_id, upload_id):
         """
         上传成功保存文件
@@ -546,6 +864,64 @@ class AliyunPan(object):
             return r.json()
         return False
 
+    def list_uploaded_parts(self, file_id: str, upload_id: str):
+        """
+        获取已上传的分块
+        :param file_id:
+        :param upload_id:
+        :return: 已上传的分块号集合，获取失败时返回None
+        """
+        url = 'https://api.aliyundrive.com/v2/file/list_uploaded_parts'
+        part_number_set = set()
+        marker = None
+        while True:
+            json = {'drive_id': self.drive_id, 'file_id': file_id, 'upload_id': upload_id}
+            if marker:
+                json['part_number_marker'] = marker
+            r = self._req.post(url, json=json)
+            if r.status_code != 200 or 'uploaded_parts' not in r.json():
+                logger.warning(f'Failed to list uploaded parts of {file_id}: {r.text}')
+                return None
+            part_number_set.update(i['part_number'] for i in r.json()['uploaded_parts'])
+            marker = r.json().get('next_part_number_marker')
+            if not marker:
+                return part_number_set
+
+    def resume_upload(self, path: str, upload_id: str, file_id: str, chunk_size: int, part_number: int = 1) -> list:
+        """
+        刷新上传链接并跳过服务端已有的分块
+        :param path:
+        :param upload_id:
+        :param file_id:
+        :param chunk_size:
+        :param part_number: 无法获取已上传的分块时，从该分块开始上传
+        :return: 分块列表，已上传的分块upload_url为空，上传任务失效时返回空列表
+        """
+        part_info_list = self.get_upload_url(path, upload_id, file_id, chunk_size)
+        if not part_info_list:
+            return []
+        uploaded = self.list_uploaded_parts(file_id, upload_id)
+        if uploaded is None:
+            # 无法获取已上传的分块，认为前面的分块都已上传
+            uploaded = set(range(1, part_number))
+        for i in part_info_list:
+            if i['part_number'] in uploaded:
+                i['upload_url'] = ''
+        return part_info_list
+
+    def _retry_resume_upload(self, path, upload_id, file_id, chunk_size, part_number):
+        """
+        网络不稳定时一直重试恢复上传，等待时间逐渐增加
+        """
+        delay = 1
+        while True:
+            time.sleep(delay)
+            try:
+                return self.resume_upload(path, upload_id, file_id, chunk_size, part_number)
+            except requests.exceptions.RequestException:
+                logger.warning(f'Failed to resume uploading {path}.')
+                delay = min(delay * 2, 30)
+
     def get_upload_url(self, path: str, upload_id: str, file_id: str, chunk_size: int, part_number: int = 1) -> list:
         """
         获取上传地址
@@ -572,7 +948,7 @@ class AliyunPan(object):
         r = self._req.post(url, json=json)
         if 'code' in r.json() and r.json()['code'] == AliyunpanCode.existed:
             raise FileExistsError
-        part_info_list = r.json()['part_info_list']
+        part_info_list = r.json().get('part_info_list') or []
         for i in part_info_list[:part_number - 1]:
             i['upload_url'] = ''
         return part_info_list
@@ -607,19 +983,31 @@ class AliyunPan(object):
         logger.debug(access_token)
         return access_token
 
-    def _access_token_gen(self) -> str:
+    def _get_access_token(self) -> str:
         """
-        access_token生成器
+        获取access_token，快过期时提前刷新
         :return:
         """
-        access_token = None
-        while True:
-            if self._access_token:
-                yield self._access_token
-            elif access_token:
-                yield access_token
-            else:
-                access_token = self.get_access_token()
+        access_token = self._access_token
+        if access_token and (self._refresh_token_expires is None
+                             or self.refresh_token_expires_sec > self._token_refresh_margin):
+            return access_token
+        return self.refresh_access_token(access_token)
+
+    def refresh_access_token(self, access_token: str = None) -> str:
+        """
+        刷新access_token，多个线程同时失效时只刷新一次
+        :param access_token: 已失效的access_token
+        :return:
+        """
+        with self._lock:
+            if access_token and self._access_token and access_token != self._access_token:
+                return self._access_token
+            try:
+                self._access_token = self.get_access_token()
+            except InvalidRefreshToken:
+                self.login()
+            return self._access_token
 
     def get_drive_id(self) -> str:
         """
@@ -648,20 +1036,36 @@ class AliyunPan(object):
             else:
                 drive_id = self.get_drive_id()
 
-    def get_download_url(self, file_id, expire_sec=14400, category=None) -> str:
+    _illegal_url = 'https://pds-system-file.oss-cn-beijing.aliyuncs.com/illegal.mp4'
+
+    def get_download_url(self, file_id, expire_sec=14400, category=None, cache=True, min_expire_sec=0) -> str:
         """
-        获取分享链接
+        获取下载链接
         :param file_id:
         :param expire_sec: 文件过期时间（秒）
         :param category:
+        :param cache: 是否使用缓存的链接，指定category时不使用缓存
+        :param min_expire_sec: 缓存的链接至少还需要的有效时间
         :return:
         """
+        # 缓存只保存普通下载链接
+        cache = cache and not category
+        if cache:
+            url = UrlCache().get(self.drive_id, file_id, min_expire_sec)
+            if url:
+                return url
         url = 'https://api.aliyundrive.com/v2/file/get_download_url'
-        illegal_url = 'https://pds-system-file.oss-cn-beijing.aliyuncs.com/illegal.mp4'
+        illegal_url = self._illegal_url
         json = {'drive_id': self.drive_id, 'file_id': file_id, 'expire_sec': expire_sec}
         logger.info(f'Get file {file_id} download link, expiration time {expire_sec} seconds.')
         r = self._req.post(url, json=json)
         url = r.json()['url'] if 'url' in r.json() else ''
+        expire_time = None
+        if url and url != illegal_url and r.json().get('expiration'):
+            try:
+                expire_time = calendar.timegm(time.strptime(r.json()['expiration'], '%Y-%m-%dT%H:%M:%S.%fZ'))
+            except ValueError:
+                pass
         if not url or url == illegal_url:
             url_dict = self.get_play_info(file_id, expire_sec, category) if category else \
                 self.get_play_info(file_id, expire_sec, 'video') or self.get_play_info(file_id, expire_sec, 'audio')
@@ -670,6 +1074,8 @@ class AliyunPan(object):
             elif 'internal_url' in r.json() and r.json()['internal_url']:
                 url = r.json()['internal_url']
         logger.debug(f'file_id:{file_id},expire_sec:{expire_sec},url:{url}')
+        if cache:
+            UrlCache().set(self.drive_id, file_id, url, expire_sec, expire_time)
         return url
 
     def save_share_link(self, name: str, content_hash: str, proof_code: str, content_hash_name: str, size: str,
@@ -707,6 +1113,19 @@ class AliyunPan(object):
         :param limit
         :param category_list
         """
+        return list(self.iter_search(query, raw, next_marker, limit_num, limit, category_list))
+
+    def iter_search(self, query: str, raw=False, next_marker: str = None, limit_num: int = 100, limit: bool = False,
+                    category_list=None):
+        """
+        逐页搜索文件
+        :param query
+        :param raw
+        :param next_marker
+        :param limit_num: 每页数量
+        :param limit: 只获取第一页
+        :param category_list
+        """
         url = 'https://api.aliyundrive.com/v2/file/search'
         if not raw:
             query = f'name match \"{query}\"'
@@ -715,23 +1134,23 @@ class AliyunPan(object):
                 if query:
                     query += ' and '
                 query += f'category = \"{i}\"'
-        json = {
-            'drive_id': self.drive_id,
-            'query': query,
-            'order_by': 'updated_at DESC',
-            'limit': limit_num
-        }
-        if next_marker:
-            json['marker'] = next_marker
-        r = self._req.post(url, json=json)
-        if 'items' not in r.json():
-            return []
-        file_list = r.json()['items']
-        if 'next_marker' in r.json() and r.json()['next_marker'] and \
-                next_marker != r.json()['next_marker'] and not limit:
-            file_list.extend(
-                self.search(query, raw=True, next_marker=r.json()['next_marker'], limit_num=limit_num))
-        return file_list
+        while True:
+            json = {
+                'drive_id': self.drive_id,
+                'query': query,
+                'order_by': 'updated_at DESC',
+                'limit': limit_num
+            }
+            if next_marker:
+                json['marker'] = next_marker
+            r = self._req.post(url, json=json)
+            data = r.json()
+            if 'items' not in data:
+                return
+            yield from data['items']
+            if not data.get('next_marker') or next_marker == data['next_marker'] or limit:
+                return
+            next_marker = data['next_marker']
 
     def get_play_info(self, file_id, expire_sec=14400, category=None):
         url = 'https://api.aliyundrive.com/v2/databox/get_{}_play_info'
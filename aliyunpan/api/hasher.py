@@ -0,0 +1,97 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
+
+from aliyunpan.api.cache import HashCache
+from aliyunpan.api.utils import logger, str_of_size, get_sha1_proof
+from aliyunpan.common import Printer, TransferBar
+
+__all__ = ['HashService']
+
+
+class HashService:
+    """
+    并发计算多个文件的sha1，结果写入sha1缓存
+    hashlib计算大块数据时会释放GIL，使用线程池即可利用多个核心
+    """
+
+    def __init__(self, workers=None, buffer_size=8388608):
+        """
+        :param workers: 同时计算的文件数，默认为CPU核心数(最多8)
+        :param buffer_size: 单次读取的大小
+        """
+        self.workers = max(int(workers or min(os.cpu_count() or 1, 8)), 1)
+        self.buffer_size = buffer_size
+        self._lock = Lock()
+        self._size = 0
+
+    def hash_file(self, path):
+        """
+        计算单个文件的sha1，文件未修改时使用缓存
+        """
+        stat = os.stat(path)
+        content_hash = HashCache().get(path, stat)
+        if content_hash:
+            return content_hash
+        content_hash = get_sha1_proof(path, split_size=self.buffer_size, progress=False)[0]
+        with self._lock:
+            self._size += stat.st_size
+        return content_hash
+
+    def imap(self, path_list, progress=True):
+        """
+        并发计算，按完成顺序返回结果
+        :param path_list: 文件路径列表，按顺序提交
+        :param progress: 是否显示总进度
+        :return: 生成(path, sha1)，计算失败时sha1为None
+        """
+        path_list = list(path_list)
+        if not path_list:
+            return
+        size_dict = {}
+        for path in path_list:
+            try:
+                size_dict[path] = os.stat(path).st_size
+            except OSError:
+                size_dict[path] = 0
+        total_size = sum(size_dict.values()) or 1
+        done_size = 0
+        bar = None
+        if progress:
+            bar = TransferBar(Printer()._hash_title, total_size, len(path_list))
+            bar.update(refresh_line=False)
+        self._size = 0
+        start_time = time.time()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = {executor.submit(self.hash_file, path): path for path in path_list}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+                try:
+                    content_hash = future.result()
+                except OSError:
+                    logger.exception(f'Failed to calculate sha1 of {path}.')
+                    content_hash = None
+                done_size += size_dict[path]
+                if bar:
+                    bar.update(ratio=done_size / total_size, done=done, refresh_line=True)
+                yield path, content_hash
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        info = self.log_stats(len(path_list), time.time() - start_time)
+        if bar:
+            bar.print_info(info, refresh_line=True)
+            bar.print_line()
+
+    def log_stats(self, count, seconds):
+        """
+        记录总的计算速度，不包括使用缓存的文件
+        """
+        speed = self._size / seconds if seconds else 0
+        info = f'hash: {count} files in {seconds:.2f}s, {str_of_size(self._size, 2)} calculated at ' \
+               f'{str_of_size(speed, 2)}/s with {self.workers} workers.'
+        logger.info(info)
+        return info
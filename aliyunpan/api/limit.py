@@ -0,0 +1,156 @@
+import io
+import time
+from threading import Lock
+
+__all__ = ['TokenBucket', 'RateLimiter', 'ThrottledReader']
+
+
+class TokenBucket:
+    """
+    令牌桶，rate为空时不限制
+    """
+    # 等待时最长的睡眠时间，保证运行中修改速率能及时生效
+    max_sleep = 0.5
+
+    def __init__(self, rate=None, burst=None):
+        """
+        :param rate: 每秒产生的令牌数
+        :param burst: 桶容量，默认为一秒的令牌数
+        """
+        self._lock = Lock()
+        self._burst = burst
+        self._rate = None
+        self._capacity = 0
+        self._tokens = 0
+        self._time = time.monotonic()
+        self.rate = rate
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        with self._lock:
+            self._set_rate(rate)
+
+    def _set_rate(self, rate):
+        self._rate = rate or None
+        self._capacity = self._burst or self._rate or 0
+        self._tokens = min(self._tokens, self._capacity)
+        self._time = time.monotonic()
+
+    def consume(self, n=1):
+        """
+        阻塞直到获得n个令牌，n大于桶容量时预支令牌
+        :param n:
+        :return: 等待的时间
+        """
+        start_time = time.monotonic()
+        while True:
+            with self._lock:
+                if not self._rate:
+                    break
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._time) * self._rate)
+                self._time = now
+                need = min(n, self._capacity)
+                if self._tokens >= need:
+                    self._tokens -= n
+                    break
+                wait = (need - self._tokens) / self._rate
+            time.sleep(min(wait, self.max_sleep))
+        return time.monotonic() - start_time
+
+
+class RateLimiter(TokenBucket):
+    """
+    请求频率限制，收到429时降低频率并暂停，之后逐步恢复
+    """
+    # 没有设置频率时，第一次被限流后使用的频率
+    throttle_rate = 10
+    min_rate = 0.5
+    # 每次成功请求恢复的频率
+    recover_step = 0.1
+    max_backoff = 60
+
+    def __init__(self, rate=None):
+        super(RateLimiter, self).__init__(rate)
+        self._limit = rate or None
+        self._backoff = 0
+        self._pause_until = 0
+
+    @property
+    def limit(self):
+        return self._limit
+
+    @limit.setter
+    def limit(self, rate):
+        with self._lock:
+            self._limit = rate or None
+            self._backoff = 0
+            self._set_rate(self._limit)
+
+    def acquire(self):
+        pause = self._pause_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+        return self.consume(1)
+
+    def throttled(self, retry_after=None):
+        """
+        被限流时降低频率
+        :param retry_after: 响应头Retry-After
+        :return: 重试前需要等待的时间
+        """
+        with self._lock:
+            rate = self._rate or self._limit or self.throttle_rate * 2
+            self._set_rate(max(rate / 2, self.min_rate))
+            self._backoff = min(self._backoff * 2 or 1, self.max_backoff)
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = self._backoff
+            self._pause_until = max(self._pause_until, time.monotonic() + delay)
+            return delay
+
+    def recover(self):
+        """
+        请求成功后逐步恢复频率
+        """
+        if not self._backoff:
+            return
+        with self._lock:
+            if not self._backoff:
+                return
+            rate = self._rate + self.recover_step
+            if self._limit and rate >= self._limit or not self._limit and rate >= self.throttle_rate * 2:
+                self._backoff = 0
+                self._set_rate(self._limit)
+            else:
+                self._backoff = max(self._backoff / 2, 1)
+                self._set_rate(rate)
+
+
+class ThrottledReader:
+    """
+    按令牌桶限速读取的请求体
+    """
+
+    def __init__(self, data, limiter_list):
+        """
+        :param data: bytes或有read、tell和__len__的对象
+        :param limiter_list:
+        """
+        self._size = len(data)
+        self._data = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+        self._limiter_list = limiter_list
+
+    def __len__(self):
+        return self._size - self._data.tell()
+
+    def read(self, size=-1):
+        chunk = self._data.read(size)
+        for limiter in self._limiter_list:
+            limiter.consume(len(chunk))
+        return chunk
@@ -1,95 +1,285 @@
 import base64
+import os
 import sys
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path, PurePosixPath
+from threading import RLock
 
 from treelib import Tree
 from treelib.exceptions import NodeIDAbsentError
 
-from aliyunpan.api.type import FileInfo, ShareInfo
-from aliyunpan.api.utils import get_sha1, get_url_byte, get_proof_code
+from aliyunpan.api.hasher import HashService
+from aliyunpan.api.type import FileInfo, ShareInfo, ChangeSet
+from aliyunpan.api.utils import get_url_byte, get_proof_code, logger
 from aliyunpan.common import GetFileListBar
 
 _all_ = ['PathList', 'parse_share_url', 'AliyunpanPath']
 
 
+class PathTree(Tree):
+    """
+    文件树，维护每个文件夹的文件名索引，节点变化时通知父文件夹id
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._names = {}
+        super(PathTree, self).__init__(*args, **kwargs)
+        self.on_change = None
+        for node in self.all_nodes_itr():
+            parent = self.parent(node.identifier)
+            if parent:
+                self._names.setdefault(parent.identifier, {})[node.tag] = node.identifier
+
+    def get_child(self, file_id, name):
+        """
+        按文件名查找子节点id
+        """
+        return self._names.get(file_id, {}).get(name)
+
+    def _index_remove(self, parent_id, node):
+        names = self._names.get(parent_id)
+        if names and names.get(node.tag) == node.identifier:
+            del names[node.tag]
+
+    def _changed(self, file_id):
+        if self.on_change and file_id is not None:
+            self.on_change(file_id)
+
+    def add_node(self, node, parent=None):
+        super(PathTree, self).add_node(node, parent)
+        if parent is not None:
+            self._names.setdefault(parent, {})[node.tag] = node.identifier
+        self._changed(parent)
+
+    def remove_node(self, identifier):
+        parent = self.parent(identifier) if self.contains(identifier) else None
+        if parent:
+            self._index_remove(parent.identifier, self[identifier])
+        if self.contains(identifier):
+            for file_id in self.expand_tree(identifier):
+                self._names.pop(file_id, None)
+        count = super(PathTree, self).remove_node(identifier)
+        if parent:
+            self._changed(parent.identifier)
+        return count
+
+    def move_node(self, source, destination):
+        parent = self.parent(source) if self.contains(source) else None
+        super(PathTree, self).move_node(source, destination)
+        if parent:
+            self._index_remove(parent.identifier, self[source])
+            self._changed(parent.identifier)
+        self._names.setdefault(destination, {})[self[source].tag] = source
+        self._changed(destination)
+
+    def update_node(self, nid, **attrs):
+        parent = self.parent(nid)
+        if parent:
+            self._index_remove(parent.identifier, self[nid])
+        super(PathTree, self).update_node(nid, **attrs)
+        if 'identifier' in attrs:
+            if nid in self._names:
+                self._names[attrs['identifier']] = self._names.pop(nid)
+            nid = attrs['identifier']
+        if parent:
+            self._names.setdefault(parent.identifier, {})[self[nid].tag] = nid
+            self._changed(parent.identifier)
+
+
 class PathList:
-    def __init__(self, disk):
-        self._tree = Tree()
+    def __init__(self, disk, tree_cache=None):
+        self._tree = PathTree()
         self._disk = disk
         self._tree.create_node(tag='root', identifier='root', data=FileInfo(type=False))
+        self._tree.on_change = self._on_tree_change
+        self._lock = RLock()
+        self._tree_cache = tree_cache
+        self._cache_loaded = False
+        self._cache_drive_id = None
+        # 从本地缓存加载且本次未重新获取的文件夹
+        self._cached_folders = set()
+        self._list_time = {}
+        self._silent = False
+        # 路径到file_id的LRU缓存，文件树变化时清空
+        self._path_cache = OrderedDict()
+        self._path_cache_size = 4096
         self.depth = 3
+        self.workers = 8
+        self.cache_ttl = 600
+
+    @property
+    def cache_enable(self):
+        return bool(self._tree_cache and self.cache_ttl and not self._disk.share.share_id)
+
+    def load_cache(self):
+        """
+        从本地缓存加载文件树
+        """
+        if self._cache_loaded or not self.cache_enable:
+            return
+        self._cache_loaded = True
+        self._cache_drive_id = self._disk.drive_id
+        file_list, folders = self._tree_cache.load(self._cache_drive_id)
+        children = {}
+        for info in file_list:
+            children.setdefault(info['parent_file_id'], []).append(info)
+        with self._lock:
+            self._silent = True
+            try:
+                folder_list = ['root']
+                while folder_list:
+                    file_id = folder_list.pop()
+                    if file_id in folders:
+                        # 包括缓存时为空的文件夹
+                        self._cached_folders.add(file_id)
+                    if file_id not in children:
+                        continue
+                    for file_info in self.get_file_info(children[file_id]):
+                        if not self._tree.get_node(file_info.id):
+                            self._tree.create_node(tag=file_info.name, identifier=file_info.id, data=file_info,
+                                                   parent=file_id)
+                            if not file_info.type:
+                                folder_list.append(file_info.id)
+            finally:
+                self._silent = False
+        self._list_time.update(folders)
+        logger.info(f'Load {len(file_list)} files from tree cache.')
+
+    def is_stale(self, file_id):
+        """
+        从缓存加载的文件夹是否过期
+        """
+        return file_id in self._cached_folders and time.time() - self._list_time.get(file_id, 0) > self.cache_ttl
+
+    def _on_tree_change(self, file_id):
+        self._path_cache.clear()
+        # 本地修改了文件树，缓存中的文件夹下次需要重新获取
+        if self._silent or not self._cache_drive_id:
+            return
+        self._list_time.pop(file_id, None)
+        self._tree_cache.invalidate(self._cache_drive_id, file_id)
 
     def update_path_list(self, file_id='root', depth=None, is_fid=True, **kwargs):
+        """
+        广度优先并发获取文件列表
+        :param file_id:
+        :param depth: 递归深度
+        :param is_fid: file_id是否为文件id，否则为路径
+        :return: 是否获取到文件列表
+        """
         if depth is None:
             depth = self.depth
-        kwargs.setdefault('max_depth', depth)
-        max_depth = kwargs['max_depth']
-        kwargs.setdefault('get_file_list_bar', GetFileListBar(max_depth))
-        kwargs.setdefault('ratio', 0)
-        get_file_list_bar = kwargs['get_file_list_bar']
-        ratio = kwargs['ratio']
+        get_file_list_bar = GetFileListBar(depth)
         get_file_list_bar.update(refresh_line=False)
         if not is_fid:
             file_id = self.get_path_fid(file_id, update=False)
-        file_list = self._disk.get_file_list(file_id)
-        if not file_list:
-            if depth == max_depth:
-                get_file_list_bar.refresh_line()
-            return False
-        old_file_list = self._tree.children(file_id)
-        for i in old_file_list:
-            if i.identifier not in [j['file_id'] for j in file_list]:
-                self._tree.remove_node(i.identifier)
-        for i, info in enumerate(file_list):
-            if depth == max_depth:
-                ratio = (i + 1) / len(file_list) if file_list else None
-            get_file_list_bar.update(depth=max_depth - depth, ratio=ratio, refresh_line=True)
-            file_info = self.get_file_info(info)[0]
-            if self._tree.get_node(file_info.id):
-                self._tree.update_node(file_info.id, data=file_info)
-            else:
-                self._tree.create_node(tag=file_info.name, identifier=file_info.id, data=file_info, parent=file_id)
-            if not file_info.type and depth:
-                self.update_path_list(file_id=file_info.id, depth=depth - 1, max_depth=max_depth,
-                                      get_file_list_bar=get_file_list_bar, ratio=ratio)
-        if depth == max_depth:
-            get_file_list_bar.refresh_line()
-        return True
-
-    def check_path_diff(self, local_path, disk_path_list):
-        p = Path(local_path)
-        change_file_list = []
-        for path in p.iterdir():
-            flag = False
-            for i, path_ in enumerate(disk_path_list, 1):
-                name, file_info = list(path_.items())[0]
-                if p / name not in p.iterdir():
-                    change_file_list.append(p / name)
-                if Path(path) == p / name:
-                    if Path(path).is_dir() and file_info['data'] and path.is_dir() != file_info['data'].type:
-                        if 'children' in file_info:
-                            children = file_info['children']
-                            change_file_list.extend(self.check_path_diff(p / name, children))
-                        elif list(path.iterdir()):
-                            change_file_list.extend(list(path.iterdir()))
-                    if file_info and file_info['data'] and path.is_file() == file_info['data'].type:
-                        if path.is_file() and get_sha1(path).lower() != file_info['data'].content_hash.lower():
-                            if i == len(disk_path_list):
-                                change_file_list.append(path)
-                            continue
-                        else:
-                            flag = True
-                if not flag and i == len(disk_path_list):
-                    change_file_list.append(path)
-        if not len(list(p.iterdir())):
-            for path_ in disk_path_list:
-                name, file_info = list(path_.items())[0]
-                change_file_list.append(p / name)
-        if not len(disk_path_list):
-            for path_ in p.iterdir():
-                change_file_list.append(path_)
-        return list(set(change_file_list))
+        result = False
+        futures = {}
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            futures[executor.submit(self._disk.get_file_list, file_id)] = (file_id, 0)
+            count = 0
+            total = 1
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    parent_file_id, level = futures.pop(future)
+                    file_list = future.result()
+                    folder_list = self.update_children(parent_file_id, file_list)
+                    if not level:
+                        result = file_list is not None
+                    if level < depth:
+                        for folder_id in folder_list:
+                            futures[executor.submit(self._disk.get_file_list, folder_id)] = (folder_id, level + 1)
+                        total += len(folder_list)
+                    count += 1
+                    get_file_list_bar.update(depth=level, ratio=count / total, refresh_line=True)
+        except BaseException:
+            # 出错时取消未开始的请求，等待正在执行的请求结束
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+        get_file_list_bar.refresh_line()
+        return result
+
+    def update_children(self, file_id, file_list):
+        """
+        更新文件夹的子节点
+        :param file_list: 为None时表示获取失败，不修改文件树；为空列表时删除所有子节点
+        :return: 子文件夹id列表
+        """
+        if file_list is None:
+            return []
+        folder_list = []
+        with self._lock:
+            self._silent = True
+            try:
+                file_id_set = {i['file_id'] for i in file_list}
+                for i in self._tree.children(file_id):
+                    if i.identifier not in file_id_set:
+                        self._tree.remove_node(i.identifier)
+                for info in file_list:
+                    file_info = self.get_file_info(info)[0]
+                    node = self._tree.get_node(file_info.id)
+                    if node:
+                        # 文件夹修改时间变化时缓存的子文件列表失效
+                        if not file_info.type and node.data and node.data.update_time != file_info.update_time:
+                            self._list_time.pop(file_info.id, None)
+                        self._tree.update_node(file_info.id, tag=file_info.name, data=file_info)
+                    else:
+                        self._tree.create_node(tag=file_info.name, identifier=file_info.id, data=file_info,
+                                               parent=file_id)
+                    if not file_info.type:
+                        folder_list.append(file_info.id)
+            finally:
+                self._silent = False
+            self._cached_folders.discard(file_id)
+            self._list_time[file_id] = time.time()
+        if self._cache_drive_id:
+            self._tree_cache.save_folder(self._cache_drive_id, file_id, file_list, self._list_time[file_id])
+        return folder_list
+
+    def check_path_diff(self, local_path, file_id):
+        """
+        比较本地文件夹与云盘文件夹
+        :param local_path: 本地文件夹
+        :param file_id: 云盘文件夹id
+        :return: ChangeSet，路径均为本地路径
+        """
+        change_set = ChangeSet([], [], [], [])
+        hash_dict = {}
+        folder_list = [(Path(local_path), file_id)]
+        while folder_list:
+            p, file_id = folder_list.pop()
+            # 未获取过或缓存已过期的文件夹先获取子文件列表
+            if self.is_stale(file_id) or file_id not in self._list_time and not self._tree.children(file_id):
+                self.update_path_list(file_id, depth=0)
+            local_dict = {entry.name: entry for entry in os.scandir(p)}
+            disk_dict = {node.tag: node.data for node in self._tree.children(file_id)}
+            for name, entry in local_dict.items():
+                path = p / name
+                file_info = disk_dict.get(name)
+                if not file_info:
+                    change_set.added.append(path)
+                elif entry.is_dir() == file_info.type:
+                    change_set.type_changed.append(path)
+                elif entry.is_dir():
+                    folder_list.append((path, file_info.id))
+                elif entry.stat().st_size != file_info.size:
+                    change_set.modified.append(path)
+                elif file_info.content_hash:
+                    hash_dict[path] = file_info.content_hash.lower()
+            for name in disk_dict.keys() - local_dict.keys():
+                change_set.deleted.append(p / name)
+        # 大小相同的文件最后并发比较sha1
+        for path, content_hash in HashService().imap(hash_dict):
+            if content_hash != hash_dict[path]:
+                change_set.modified.append(path)
+        return change_set
 
     @staticmethod
     def get_file_info(info):
@@ -142,7 +332,7 @@ class PathList:
         try:
             self.auto_update_path_list(update, file_id)
         except NodeIDAbsentError:
-            return list(map(self.get_file_info, self._disk.get_file_list(file_id)))
+            return list(map(self.get_file_info, self._disk.get_file_list(file_id) or []))
         if not self._tree.get_node(file_id):
             return []
         if file_id != 'root' and self._tree.get_node(file_id).data.type:
@@ -152,27 +342,37 @@ class PathList:
     def get_path_fid(self, path, file_id='root', update=True):
         if str(path) in ('', '/', '\\', '.', 'root'):
             return 'root'
+        self.load_cache()
         path = AliyunpanPath(path)
-        flag = False
+        key = (file_id, str(path))
+        if key in self._path_cache:
+            with self._lock:
+                if key in self._path_cache and self._tree.contains(self._path_cache[key]):
+                    self._path_cache.move_to_end(key)
+                    return self._path_cache[key]
         path_list = list(filter(None, path.split()))
         if path_list[0] == 'root':
             path_list = path_list[1:]
         for i in path_list:
-            flag = False
-            node_list = self._tree.children(file_id)
-            if not node_list:
+            if not self._tree.children(file_id):
                 self.auto_update_path_list(update, file_id)
-                node_list = self._tree.children(file_id)
-            for j in node_list:
-                if i == j.tag:
-                    flag = True
-                    file_id = j.identifier
-                    break
-            if not flag:
+            elif self.is_stale(file_id):
+                self.update_path_list(file_id, depth=0)
+            child_id = self._tree.get_child(file_id, i)
+            # 缓存中找不到时重新获取
+            if not child_id and file_id in self._cached_folders:
+                self.update_path_list(file_id, depth=0)
+                child_id = self._tree.get_child(file_id, i)
+            if not child_id:
                 return False
-        if flag:
-            return file_id
-        return False
+            file_id = child_id
+        if not path_list:
+            return False
+        with self._lock:
+            self._path_cache[key] = file_id
+            if len(self._path_cache) > self._path_cache_size:
+                self._path_cache.popitem(last=False)
+        return file_id
 
     def get_path_node(self, path, update=True):
         file_id = self.get_path_fid(path, update=update)
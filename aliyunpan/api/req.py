@@ -1,20 +1,32 @@
-import json
-import sys
-from threading import RLock
+import logging
+import time
+from urllib.parse import urlparse
 
 import requests
-import simplejson
+import requests.adapters
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+from aliyunpan.api.limit import RateLimiter, ThrottledReader, TokenBucket
 from aliyunpan.api.utils import logger
 from aliyunpan.common import *
-from aliyunpan.exceptions import AliyunpanCode, InvalidAccessToken, InvalidRefreshToken, LoginFailed
+from aliyunpan.exceptions import InvalidAccessToken, AliyunpanCode
 
-__all__ = ['Req']
+__all__ = ['Req', 'Response']
 
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
+class Response(requests.Response):
+    """
+    只解析一次json的响应
+    """
+
+    def json(self, **kwargs):
+        if '_json' not in self.__dict__:
+            self._json = super(Response, self).json(**kwargs)
+        return self._json
+
+
 class Req:
     _instance = None
     _first_init = True
@@ -29,9 +41,18 @@ class Req:
             return
         self._first_init = False
         self._disk = disk
-        self._lock = RLock()
         self._retry_num = 3
-        self._session = requests.Session()
+        # api、上传、下载分别使用独立的连接池
+        self._pool_size = {'api': 16, 'upload': 16, 'download': 16}
+        self._sessions = {}
+        self._request_count = dict.fromkeys(self._pool_size, 0)
+        for kind in self._pool_size:
+            self._sessions[kind] = requests.Session()
+            self._mount(kind)
+        # 上传、下载的总带宽限制和单个文件的带宽限制(字节/秒)，api请求频率限制(次/秒)
+        self._bandwidth = {'upload': TokenBucket(), 'download': TokenBucket()}
+        self._transfer_bandwidth = {'upload': None, 'download': None}
+        self._rate_limiter = RateLimiter()
         self._timeout = 5
         self._verify = False
         self._host_url = 'https://www.aliyundrive.com/'
@@ -44,59 +65,145 @@ class Req:
     timeout = property(lambda self: self._timeout, lambda self, value: setattr(self, '_timeout', value))
     verify = property(lambda self: self._verify, lambda self, value: setattr(self, '_verify', value))
     retry_num = property(lambda self: self._retry_num, lambda self, value: setattr(self, '_retry_num', value))
+    _api_hosts = ('api.aliyundrive.com', 'auth.aliyundrive.com', 'passport.aliyundrive.com', 'websv.aliyundrive.com')
+
+    def _mount(self, kind):
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self._pool_size[kind])
+        self._sessions[kind].mount('https://', adapter)
+        self._sessions[kind].mount('http://', adapter)
+
+    def set_pool_size(self, size, kind=None):
+        """
+        设置每个host的连接池大小
+        :param size:
+        :param kind: api、upload或download，默认全部
+        """
+        for kind in [kind] if kind else list(self._pool_size):
+            if self._pool_size[kind] != size:
+                self._pool_size[kind] = size
+                self._mount(kind)
+
+    def ensure_pool_size(self, size, kind=None):
+        """
+        连接池小于并发数时扩大连接池
+        """
+        for kind in [kind] if kind else list(self._pool_size):
+            if self._pool_size[kind] < size:
+                self.set_pool_size(size, kind)
+
+    def set_bandwidth(self, rate, kind=None):
+        """
+        设置总带宽限制，运行中修改立即生效
+        :param rate: 字节/秒，None为不限制
+        :param kind: upload或download，默认全部
+        """
+        for kind in [kind] if kind else list(self._bandwidth):
+            self._bandwidth[kind].rate = rate
+
+    def set_transfer_bandwidth(self, rate, kind=None):
+        """
+        设置单个文件的带宽限制，对之后开始的传输生效
+        :param rate: 字节/秒，None为不限制
+        :param kind: upload或download，默认全部
+        """
+        for kind in [kind] if kind else list(self._transfer_bandwidth):
+            self._transfer_bandwidth[kind] = rate or None
+
+    def set_request_rate(self, rate):
+        """
+        设置api请求频率限制
+        :param rate: 次/秒，None为不限制
+        """
+        self._rate_limiter.limit = rate
+
+    def get_limiter_list(self, kind):
+        """
+        获取一次传输使用的令牌桶，包括总带宽和单个文件的带宽
+        :param kind: upload或download
+        :return:
+        """
+        limiter_list = [self._bandwidth[kind]]
+        if self._transfer_bandwidth[kind]:
+            limiter_list.append(TokenBucket(self._transfer_bandwidth[kind]))
+        return limiter_list
+
+    @staticmethod
+    def throttle(size, limiter_list):
+        """
+        传输size字节前等待令牌
+        """
+        for limiter in limiter_list:
+            limiter.consume(size)
+
+    @staticmethod
+    def throttled_data(data, limiter_list):
+        """
+        限速的请求体，没有限制时返回原数据
+        """
+        if any(i.rate for i in limiter_list):
+            return ThrottledReader(data, limiter_list)
+        return data
+
+    def _get_kind(self, method, url):
+        if urlparse(url).hostname in self._api_hosts:
+            return 'api'
+        return 'upload' if method.lower() == 'put' else 'download'
+
+    def stats(self):
+        """
+        各连接池的请求数和新建连接数
+        """
+        stats = {}
+        for kind, session in self._sessions.items():
+            connections = 0
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool:
+                        connections += pool.num_connections
+            stats[kind] = {'requests': self._request_count[kind], 'connections': connections}
+        return stats
 
     def _req(self, method, *args, **kwargs):
-        try:
-            kwargs.setdefault('timeout', self._timeout)
-            kwargs.setdefault('verify', self._verify)
-            kwargs.setdefault('stream', False)
-            stream = kwargs['stream']
-            kwargs.setdefault('depth', self._retry_num)
-            depth = kwargs.pop('depth')
-            kwargs['headers'] = kwargs['headers'] if 'headers' in kwargs else {}
-            kwargs['headers'].update(self._headers)
-            if 'access_token' in kwargs:
-                if kwargs['access_token']:
-                    kwargs['headers']['Authorization'] = kwargs['access_token']
-                else:
-                    kwargs['headers']['Authorization'] = None
-                del kwargs['access_token']
-            else:
-                kwargs['headers']['Authorization'] = self._disk.access_token if self._disk else GLOBAL_VAR.access_token
+        kwargs.setdefault('timeout', self._timeout)
+        kwargs.setdefault('verify', self._verify)
+        depth = kwargs.pop('depth', self._retry_num)
+        kwargs['headers'] = kwargs['headers'] if 'headers' in kwargs else {}
+        kwargs['headers'].update(self._headers)
+        # 指定了access_token时不自动刷新
+        auto_refresh = 'access_token' not in kwargs
+        if not auto_refresh:
+            kwargs['headers']['Authorization'] = kwargs.pop('access_token') or None
+        else:
+            kwargs['headers']['Authorization'] = self._disk.access_token if self._disk else GLOBAL_VAR.access_token
+        if logger.isEnabledFor(logging.DEBUG):
             logger.debug(f'{method.lower()}, {args}, {kwargs}')
-            r = getattr(self._session, method.lower())(*args, **kwargs)
-            try:
-                logger.debug(r.status_code)
+        kind = kwargs.pop('kind', None) or self._get_kind(method, kwargs.get('url') or args[0])
+        self._request_count[kind] += 1
+        if kind == 'api':
+            self._rate_limiter.acquire()
+        r = getattr(self._sessions[kind], method.lower())(*args, **kwargs)
+        r.__class__ = Response
+        logger.debug(r.status_code)
+        if kind == 'api':
+            if r.status_code == AliyunpanCode.too_many_requests:
+                delay = self._rate_limiter.throttled(r.headers.get('Retry-After'))
+                logger.warning(f'Too many requests, request rate is limited to {self._rate_limiter.rate:.2f}/s.')
                 if depth:
-                    self._lock.acquire()
-                    if self._disk and not stream and json.loads(r.text)['code'] == AliyunpanCode.token_invalid \
-                            or self._disk.refresh_token_expires_sec < 600:
-                        depth -= 1
-                        try:
-                            self._disk.access_token = self._disk.get_access_token()
-                        except InvalidRefreshToken:
-                            self._disk.login()
-                        self._lock.release()
-                        return self._req(method, depth=depth, *args, **kwargs)
-                    self._lock.release()
-                else:
-                    raise InvalidAccessToken
-            except (KeyboardInterrupt, InvalidAccessToken, LoginFailed):
-                raise
-            except (json.decoder.JSONDecodeError, simplejson.errors.JSONDecodeError):
-                logger.debug(r.text)
-            except KeyError:
-                pass
-            except:
-                logger.debug(sys.exc_info())
-            finally:
-                try:
-                    self._lock.release()
-                except RuntimeError:
-                    pass
-            return r
-        except requests.exceptions.RequestException:
-            raise
+                    time.sleep(delay)
+                    if not auto_refresh:
+                        kwargs['access_token'] = kwargs['headers']['Authorization']
+                    return self._req(method, *args, depth=depth - 1, kind=kind, **kwargs)
+            else:
+                self._rate_limiter.recover()
+        if r.status_code == 401 and auto_refresh and self._disk:
+            if not depth:
+                raise InvalidAccessToken
+            logger.info('Access token is invalid.')
+            self._disk.refresh_access_token(kwargs['headers']['Authorization'])
+            return self._req(method, *args, depth=depth - 1, **kwargs)
+        return r
 
     def get(self, *args, **kwargs) -> requests.models.Response:
         return self._req('get', *args, **kwargs)
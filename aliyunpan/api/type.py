@@ -1,7 +1,7 @@
 from collections import namedtuple
 from pathlib import Path
 
-__all__ = ['FileInfo', 'UserInfo', 'ShareInfo', 'AlibumInfo', 'Share', 'File']
+__all__ = ['FileInfo', 'UserInfo', 'ShareInfo', 'AlibumInfo', 'ChangeSet', 'Share', 'File']
 
 _file_info = (
     'name', 'id', 'pid', 'type', 'ctime', 'update_time', 'hidden', 'category', 'content_type', 'size',
@@ -16,6 +16,8 @@ ShareInfo = namedtuple('ShareInfo', ['name', 'content_hash', 'proof_code', 'cont
 ShareInfo.__new__.__defaults__ = ('',) * 6
 AlibumInfo = namedtuple('AlibumInfo', ['drive_name', 'drive_id'])
 AlibumInfo.__new__.__defaults__ = ('',) * 2
+# 本地相对云盘的变化: 新增、修改、删除、文件与文件夹类型不同
+ChangeSet = namedtuple('ChangeSet', ['added', 'modified', 'deleted', 'type_changed'])
 
 
 class Share:
@@ -33,6 +35,8 @@ class File:
     def __init__(self, file_id: str, path: Path):
         self.file_id = file_id
         self.path = path
+        # 复制分享文件时新文件的id
+        self.new_file_id = None
 
     def __getitem__(self, item):
         if item == 0:
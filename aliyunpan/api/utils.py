@@ -4,6 +4,7 @@ import hashlib
 import inspect
 import json
 import logging
+import mmap
 import os
 import socket
 import sys
@@ -12,8 +13,9 @@ from pathlib import Path
 import requests
 import rsa
 
-__all__ = ['ROOT_DIR', 'logger', 'log_file', 'get_sha1', 'str_of_size', 'Iter', 'encrypt', 'parse_biz_ext',
-           'stop_thread', 'get_open_port', 'get_real_path', 'get_proof_code', 'get_url_byte', 'get_file_byte']
+__all__ = ['ROOT_DIR', 'logger', 'log_file', 'get_sha1', 'get_sha1_proof', 'get_pre_hash', 'str_of_size', 'Iter', 'encrypt',
+           'parse_biz_ext', 'stop_thread', 'get_open_port', 'get_real_path', 'get_proof_code', 'get_proof_range',
+           'get_url_byte', 'get_file_byte', 'FileMap', 'FileWindow']
 
 ROOT_DIR = str(Path(os.environ.get('ALIYUNPAN_ROOT')).resolve().absolute()) if os.environ.get(
     'ALIYUNPAN_ROOT') else os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -30,30 +32,64 @@ logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
 def get_sha1(path, split_size=524288):
+    return get_sha1_proof(path, split_size=split_size)[0]
+
+
+def get_sha1_proof(path, access_token: str = None, split_size=524288, content_hash=None, progress=True):
+    """
+    一次读取同时计算sha1和proof_code所需的8字节，文件未修改时使用本地缓存的sha1
+    :param path:
+    :param access_token: 为空时不获取proof字节
+    :param split_size:
+    :param content_hash: 已经计算好的sha1，不为空时只获取proof字节
+    :param progress: 是否显示进度
+    :return: (sha1, proof_bytes)
+    """
+    from aliyunpan.api.cache import HashCache
+    hash_cache = HashCache()
+    stat = os.stat(path)
+    content_hash = content_hash or hash_cache.get(path, stat)
+    if content_hash:
+        return content_hash, get_file_byte(Path(path), access_token) if access_token else b''
     logger.info(f'Calculate sha1 of file {path}.')
-    file_size = os.path.getsize(path)
+    file_size = stat.st_size
+    proof_start, proof_end = get_proof_range(access_token, file_size) if access_token else (0, 0)
+    proof_bytes = b''
     from aliyunpan.common import HashBar
-    hash_bar = HashBar(size=file_size)
-    hash_bar.hash_info(path, size=file_size)
-    hash_bar.print_line()
-    hash_bar.update(refresh_line=False)
+    hash_bar = HashBar(size=file_size) if progress else None
+    if hash_bar:
+        hash_bar.hash_info(path, size=file_size)
+        hash_bar.print_line()
+        hash_bar.update(refresh_line=False)
     with open(path, 'rb') as f:
         sha1 = hashlib.sha1()
-        count = 0
+        offset = 0
         while True:
             chunk = f.read(split_size)
-            k = ((count * split_size) + len(chunk)) / file_size if file_size else 0
-            hash_bar.update(ratio=k, refresh_line=True)
+            if hash_bar:
+                k = (offset + len(chunk)) / file_size if file_size else 0
+                hash_bar.update(ratio=k, refresh_line=True)
             if not chunk:
                 break
-            count += 1
+            if offset < proof_end and offset + len(chunk) > proof_start:
+                proof_bytes += chunk[max(proof_start - offset, 0):proof_end - offset]
+            offset += len(chunk)
             sha1.update(chunk)
         content_hash = sha1.hexdigest()
     logger.info(f'The SHA1 of file {path} is {content_hash}.')
-    hash_bar.refresh_line()
-    hash_bar.hash_info(path, status=True, size=file_size, refresh_line=True)
-    hash_bar.print_line()
-    return content_hash
+    # 计算期间文件未被修改才写入缓存
+    if os.stat(path).st_mtime_ns == stat.st_mtime_ns:
+        hash_cache.set(path, content_hash, stat)
+    if hash_bar:
+        hash_bar.refresh_line()
+        hash_bar.hash_info(path, status=True, size=file_size, refresh_line=True)
+        hash_bar.print_line()
+    return content_hash, proof_bytes
+
+
+def get_pre_hash(path, size=1024):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read(size)).hexdigest()
 
 
 def get_proof_code(bys: bytes) -> str:
@@ -61,13 +97,97 @@ def get_proof_code(bys: bytes) -> str:
     return proof_code
 
 
-def get_file_byte(path: Path, access_token: str = None):
+def get_proof_range(access_token: str, file_size: int):
     n1 = int(hashlib.md5(access_token.encode()).hexdigest()[:16], 16)
-    n2 = path.stat().st_size
+    n2 = file_size
     n3 = (n1 % n2) if n2 else 0
+    return n3, min(n3 + 8, n2)
+
+
+def get_file_byte(path: Path, access_token: str = None):
+    start, end = get_proof_range(access_token, path.stat().st_size)
     with path.open('rb') as f:
-        f.seek(n3)
-        return f.read(min(n3 + 8, n2) - n3)
+        f.seek(start)
+        return f.read(end - start)
+
+
+class FileMap:
+    """
+    只读映射文件，多个线程共用一个文件句柄按偏移读取
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self._size else None
+
+    size = property(lambda self: self._size)
+
+    def read(self, offset, size):
+        if not self._map:
+            return b''
+        return self._map[offset:offset + size]
+
+    def window(self, offset, size):
+        """
+        文件中一段范围的只读视图，用于流式上传分块
+        """
+        return FileWindow(self, offset, max(min(size, self._size - offset), 0))
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class FileWindow:
+    """
+    按块读取文件的一段范围，不会一次读入整个分块
+    """
+    block_size = 65536
+
+    def __init__(self, file_map, offset, size):
+        self._file_map = file_map
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.block_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self._size - self._pos
+        size = min(size, self._size - self._pos)
+        if size <= 0:
+            return b''
+        chunk = self._file_map.read(self._offset + self._pos, size)
+        self._pos += len(chunk)
+        return chunk
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = min(max(offset, 0), self._size)
+        return self._pos
 
 
 def get_url_byte(url: str, access_token: str = None, file_size: int = None):
@@ -75,10 +195,8 @@ def get_url_byte(url: str, access_token: str = None, file_size: int = None):
     req = Req()
     if not file_size:
         file_size = int(req.get(url, stream=True).headers.get('Content-Length'))
-    n1 = int(hashlib.md5(access_token.encode()).hexdigest()[:16], 16)
-    n2 = file_size
-    n3 = (n1 % n2) if n2 else 0
-    headers = {'Range': f'bytes={n3}-{min(n3 + 8, n2) - 1}'}
+    start, end = get_proof_range(access_token, file_size)
+    headers = {'Range': f'bytes={start}-{end - 1}'}
     r: requests.Response = req.get(url, headers=headers, stream=True)
     return r.content
 
@@ -1,23 +1,34 @@
 import functools
+import itertools
+import json
 import os
 import platform
 import re
 import shutil
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import RLock
 from typing import List, Union
 
 import aria2p
 import requests
 from aria2p import Options
 
+from aliyunpan.api.cache import HashCache, TreeCache, UrlCache, TaskJournal
 from aliyunpan.api.core import AliyunPan
+from aliyunpan.api.hasher import HashService
 from aliyunpan.api.models import *
 from aliyunpan.api.req import *
 from aliyunpan.api.type import Share, File
 from aliyunpan.api.utils import *
 from aliyunpan.cli.config import Config
+from aliyunpan.cli.pack import Manifest, manifest_name, pack_dir, unpack_dir
+from aliyunpan.cli.scheduler import TransferScheduler
+from aliyunpan.cli.watch import get_watcher
 from aliyunpan.common import *
 from aliyunpan.exceptions import InvalidRefreshToken, InvalidPassword, InvalidConfiguration, \
-    ConfigurationFileNotFoundError, AliyunpanCode, CreateDirError
+    ConfigurationFileNotFoundError, AliyunpanCode, AliyunpanException, CreateDirError
 
 __all__ = ['Commander']
 
@@ -27,24 +38,32 @@ class Commander:
         self.match = False
         self.whitelist = False
         self._disk = AliyunPan()
-        self._path_list = PathList(self._disk)
+        self._path_list = PathList(self._disk, TreeCache())
         self._req = Req(self._disk)
         self._config = Config()
         self._task_config = Config(ROOT_DIR / Path('tasks.yaml'))
         self._share_link = 'aliyunpan://'
+        self._state_suffix = '.aliyunpan'
+        # 监听同步失败后重试的间隔
+        self._sync_retry_interval = 30
         self._print = Printer()
         self._host_url = 'https://www.aliyundrive.com/'
         self._aria2 = None
         self.filter_set = set()
         self._config_set = {'~/.config/aliyunpan.yaml', '.config/aliyunpan.yaml', '~/aliyunpan.yaml', 'aliyunpan.yaml',
                             os.environ.get('ALIYUNPAN_CONF', '')}
-        GLOBAL_VAR.tasks = self._task_config.read()
+        GLOBAL_VAR.tasks = TaskJournal()
+        # 导入旧版本保存的任务
+        if self._task_config.config_file.is_file():
+            if GLOBAL_VAR.tasks.migrate(self._task_config.read()):
+                self._task_config.config_file.unlink()
         GLOBAL_VAR.txt = ''
         if init:
             self.init(*args, **kwargs)
 
     def __del__(self):
-        self._task_config.write(GLOBAL_VAR.tasks)
+        GLOBAL_VAR.tasks.compact()
+        logger.info(f'Connection pool stats: {self._req.stats()}')
         if self._disk.refresh_token:
             try:
                 self._config.update('refresh_token', self._disk.refresh_token)
@@ -52,9 +71,19 @@ class Commander:
                 pass
 
     def init(self, config_file=None, refresh_token=None, username=None, password=None, depth=3, timeout=None,
-             drive_id=None, album=False, share_id='', share_pwd='', filter_file=None, whitelist=False, match=False):
+             drive_id=None, album=False, share_id='', share_pwd='', filter_file=None, whitelist=False, match=False,
+             rehash=False, cache_ttl=600, pool_size=16, upload_limit=None, download_limit=None, file_limit=None,
+             request_limit=None):
         self._path_list.depth = depth
+        self._path_list.cache_ttl = cache_ttl
+        HashCache().rehash = rehash
+        UrlCache().persist = bool(cache_ttl)
         self._req.timeout = timeout
+        self._req.set_pool_size(pool_size)
+        self._req.set_bandwidth(upload_limit, 'upload')
+        self._req.set_bandwidth(download_limit, 'download')
+        self._req.set_transfer_bandwidth(file_limit)
+        self._req.set_request_rate(request_limit)
         self._disk.drive_id = drive_id
         self._disk.album = album
         self._disk._share = Share(share_id, share_pwd)
@@ -113,24 +142,47 @@ class Commander:
 
     def ls(self, path='root', l=False, query=None):
         if query:
-            file_info_list = self._path_list.get_file_info(self._disk.search(query))
+            file_info_list = (self._path_list.get_file_info(i)[0] for i in self._disk.iter_search(query))
         else:
-            file_info_list = self._path_list.get_path_list(path, update=False)
+            file_info_list = self.iter_path_list(path)
         if self.filter_set:
-            file_info_list = [i for i in file_info_list if self.file_filter(i.name)]
+            file_info_list = (i for i in file_info_list if self.file_filter(i.name))
+        # 获取到第一页后就开始输出
         for i, j in enumerate(file_info_list):
             if l:
+                if i:
+                    print()
                 if j.type:
                     print(str_of_size(j.size), time.strftime('%d %b %H:%M', j.ctime), j.id, j.name, end='')
                 else:
                     print('-', time.strftime('%d %b %H:%M', j.ctime), j.id, j.name, end='')
-                if i + 1 < len(file_info_list):
-                    print()
             else:
                 print(j.name, end='\t')
+            sys.stdout.flush()
         if platform.system() != 'Windows':
             print()
 
+    def iter_path_list(self, path='root'):
+        file_id = self._path_list.get_path_fid(path, update=False)
+        if not file_id:
+            raise FileNotFoundError(path)
+        node = self._path_list._tree.get_node(file_id)
+        if file_id != 'root' and node and node.data.type:
+            yield node.data
+            return
+        file_list = []
+        iterator = self._disk.iter_file_list(file_id)
+        while True:
+            try:
+                info = next(iterator)
+            except StopIteration as e:
+                # 获取失败时不修改文件树
+                if e.value is not False:
+                    self._path_list.update_children(file_id, file_list)
+                return
+            file_list.append(info)
+            yield self._path_list.get_file_info(info)[0]
+
     def get_path_list(self, path='root') -> List[FileInfo]:
         return self._path_list.get_path_list(path, update=False)
 
@@ -141,24 +193,37 @@ class Commander:
         return self._path_list.tree(path, stdout)
 
     def rm(self, path, file_id=None):
-        if not self.file_filter(path):
-            return False
-        if not file_id:
-            file_id = self._path_list.get_path_fid(path, update=False)
         if file_id:
-            file_id_ = self._disk.delete_file(file_id)
-            if file_id_ == file_id:
-                file_id = file_id_
-                self._print.remove_info(path or file_id, status=True)
-                self._path_list._tree.remove_node(file_id)
-                self._print.print_line()
-            else:
-                file_id = False
-                self._print.remove_info(path or file_id, status=False)
-                self._print.print_line()
+            file_dict = {file_id: path}
         else:
-            raise FileNotFoundError(path or file_id)
-        return file_id
+            path_list = [path] if isinstance(path, (str, PurePosixPath, Path)) else path
+            file_dict = {}
+            for path in filter(self.file_filter, path_list):
+                file_id = self._path_list.get_path_fid(path, update=False)
+                if not file_id:
+                    raise FileNotFoundError(path)
+                file_dict[file_id] = path
+        if not file_dict:
+            return False
+        result = self.rm_files(file_dict)
+        if len(file_dict) == 1:
+            file_id = list(file_dict)[0]
+            return file_id if result[file_id] else False
+        return [file_id for file_id, status in result.items() if status]
+
+    def rm_files(self, file_dict):
+        """
+        :param file_dict: {file_id: path}
+        :return: {file_id: 是否删除成功}
+        """
+        result = self._disk.delete_files(list(file_dict))
+        for file_id, status in result.items():
+            self._print.remove_info(file_dict[file_id] or file_id, status=status)
+            # 父文件夹可能已经删除
+            if status and self._path_list._tree.contains(file_id):
+                self._path_list._tree.remove_node(file_id)
+            self._print.print_line()
+        return result
 
     def rename(self, path, name):
         if not self.file_filter(path):
@@ -207,17 +272,17 @@ class Commander:
                 continue
             elif not parent_file_id:
                 raise FileNotFoundError(target_path)
-        file_list.extend(self.move_by_file_id_list(file_list_, parent_file_id))
         if file_list_:
+            self.move_by_file_id_list(file_list_, parent_file_id)
             for file in file_list_:
-                if file:
-                    if file.file_id:
-                        self._print.move_info(file.path, target_path, status=True)
+                if file.file_id:
+                    self._print.move_info(file.path, target_path, status=True)
+                    if self._path_list._tree.contains(file.file_id):
                         self._path_list._tree.remove_node(file.file_id)
-                        self._path_list.update_path_list(Path(target_path) / file.path.name, is_fid=False)
-                    else:
-                        self._print.move_info(file.path, target_path, status=False)
-                    self._print.print_line()
+                else:
+                    self._print.move_info(file.path, target_path, status=False)
+                self._print.print_line()
+            self._path_list.update_path_list(parent_file_id, depth=0)
         return file_list
 
     def move_by_path(self, path, target_path):
@@ -293,7 +358,9 @@ class Commander:
         return not whitelist
 
     def upload(self, path, upload_path='root', timeout=10.0, retry=3, force=False, share=False, chunk_size=None,
-               c=False, ignore=False):
+               c=False, ignore=False, parallel=1, jobs=1, pack=False, pack_threshold=1048576,
+               pack_size=1073741824, hash_jobs=0):
+        self._req.ensure_pool_size(parallel * max(jobs, 1), 'upload')
         if isinstance(path, (str, AliyunpanPath, Path)):
             path_list = {path}
         else:
@@ -355,7 +422,7 @@ class Commander:
                         result = self._disk.upload_file(
                             parent_file_id=parent_file_id, path=str(path),
                             upload_timeout=timeout, retry_num=retry, force=force, chunk_size=chunk_size, c=c,
-                            ignore=ignore)
+                            ignore=ignore, parallel=parallel)
                     except KeyboardInterrupt:
                         self.__del__()
                         raise
@@ -372,20 +439,59 @@ class Commander:
                 if upload_path == 'root':
                     upload_path = '/'
                 upload_path = Path(upload_path)
-                upload_file_list = self.upload_dir(path, upload_path)
+                scheduler = TransferScheduler(self._print._upload_title, jobs)
+                pack_tmp = None
+                packer = None
+                if pack:
+                    # 小文件打包为tar分段上传到文件夹根目录
+                    pack_tmp = tempfile.TemporaryDirectory(prefix='aliyunpan-pack-')
+                    packer = pack_dir(path, pack_tmp.name, pack_threshold, pack_size, self.file_filter)
+                upload_file_list = self.upload_dir(path, upload_path, packer.packed if packer else None)
                 upload_file_list = [i for i in upload_file_list if self.file_filter(i[1])]
+                task_dict = {}
                 for file in upload_file_list:
-                    try:
-                        parent_file_id = self._path_list.get_path_fid(file[0], update=False)
-                        if not parent_file_id:
-                            raise FileNotFoundError(upload_path)
-                        result = self._disk.upload_file(
-                            parent_file_id=parent_file_id, path=file[1],
-                            upload_timeout=timeout, retry_num=retry, force=force, chunk_size=chunk_size, c=c,
-                            ignore=ignore)
-                    except KeyboardInterrupt:
-                        self.__del__()
-                        raise
+                    parent_file_id = self._path_list.get_path_fid(file[0], update=False)
+                    if not parent_file_id:
+                        raise FileNotFoundError(upload_path)
+                    # 与TransferScheduler.add的参数一致: (label, size, func, args, kwargs)
+                    task_dict[file[1]] = (file[1], file[1].stat().st_size, self._disk.upload_file, (),
+                                          {'parent_file_id': parent_file_id, 'path': file[1],
+                                           'upload_timeout': timeout, 'retry_num': retry, 'force': force,
+                                           'chunk_size': chunk_size, 'c': c, 'ignore': ignore,
+                                           'parallel': parallel})
+                source_list, source_size, source_count = [], 0, 0
+                if hash_jobs:
+                    # 并发计算sha1，计算完成的文件按完成顺序开始上传
+                    path_list_ = sorted(task_dict, key=lambda x: task_dict[x][1])
+                    # 把计算好的sha1传给upload_file，避免重复计算
+                    source_list.append(
+                        task_dict[i][:4] + (dict(task_dict[i][4], content_hash=content_hash),)
+                        for i, content_hash in HashService(hash_jobs).imap(path_list_, progress=False))
+                    source_size += sum(i[1] for i in task_dict.values())
+                    source_count += len(task_dict)
+                else:
+                    for task in task_dict.values():
+                        scheduler.add(*task)
+                if packer:
+                    # 分段在调度器取出任务时才写入，上传后立即删除
+                    pack_file_id = self._path_list.get_path_fid(upload_path / path.name, update=False)
+                    if not pack_file_id:
+                        self.mkdir(upload_path / path.name)
+                        pack_file_id = self._path_list.get_path_fid(upload_path / path.name, update=False)
+                    if not pack_file_id:
+                        raise FileNotFoundError(upload_path / path.name)
+                    source_list.append(
+                        (segment, segment.stat().st_size, self.upload_segment, (segment,),
+                         {'parent_file_id': pack_file_id, 'upload_timeout': timeout, 'retry_num': retry,
+                          'force': force, 'chunk_size': chunk_size, 'c': c, 'ignore': ignore, 'parallel': parallel})
+                        for segment in packer)
+                    source_size += packer.size
+                    source_count += len(packer)
+                if source_list:
+                    scheduler.add_source(itertools.chain(*source_list), source_size, source_count)
+
+                def upload_callback(transfer_result):
+                    result = transfer_result.result
                     if result:
                         if isinstance(result, str):
                             file_id = result
@@ -393,8 +499,17 @@ class Commander:
                             file_info = self._path_list.get_file_info(result)[0]
                             file_id = file_info.id
                             self._path_list._tree.create_node(tag=file_info.name, identifier=file_info.id,
-                                                              parent=parent_file_id, data=file_info)
+                                                              parent=file_info.pid, data=file_info)
                         result_list.append(file_id)
+
+                try:
+                    scheduler.run(upload_callback)
+                except KeyboardInterrupt:
+                    self.__del__()
+                    raise
+                finally:
+                    if pack_tmp:
+                        pack_tmp.cleanup()
             else:
                 raise FileNotFoundError
             for file_hash, path in GLOBAL_VAR.file_set:
@@ -402,25 +517,47 @@ class Commander:
                     if isinstance(GLOBAL_VAR.tasks[file_hash].path, str):
                         del GLOBAL_VAR.tasks[file_hash]
                     else:
-                        try:
-                            GLOBAL_VAR.tasks[file_hash].path.remove(path)
-                        except ValueError:
-                            pass
-                        if not GLOBAL_VAR.tasks[file_hash].path:
+                        path_list = [i for i in GLOBAL_VAR.tasks[file_hash].path if i != path]
+                        if path_list:
+                            GLOBAL_VAR.tasks[file_hash].path = path_list
+                        else:
                             del GLOBAL_VAR.tasks[file_hash]
         return result_list
 
-    def upload_dir(self, path, upload_path):
+    def upload_segment(self, path, **kwargs):
+        """
+        上传打包的分段，完成后删除本地分段
+        :param path: 分段或清单的路径
+        :param kwargs: upload_file的参数
+        :return:
+        """
+        try:
+            return self._disk.upload_file(path=path, **kwargs)
+        finally:
+            try:
+                Path(path).unlink()
+            except OSError:
+                pass
+
+    def upload_dir(self, path, upload_path, exclude=None):
+        """
+        创建远程文件夹并获取需要上传的文件列表
+        :param path: 本地文件夹
+        :param upload_path: 远程父文件夹
+        :param exclude: 不单独上传的文件集合(已打包的文件)，只包含这些文件的文件夹不创建
+        :return: [[远程文件夹, 本地文件], ...]
+        """
         upload_path = upload_path / path.name
-        if not self._path_list.get_path_fid(upload_path, update=False):
-            self.mkdir(upload_path)
-            self._print.print_line()
         upload_file_list = []
         for file in path.iterdir():
             if file.is_dir():
-                upload_file_list.extend(self.upload_dir(file, upload_path))
-            else:
+                upload_file_list.extend(self.upload_dir(file, upload_path, exclude))
+            elif not exclude or file not in exclude:
                 upload_file_list.append([upload_path, file])
+        # 子文件夹创建时会先创建父文件夹，这里只需要补上没有子文件的文件夹
+        if (exclude is None or upload_file_list) and not self._path_list.get_path_fid(upload_path, update=False):
+            self.mkdir(upload_path)
+            self._print.print_line()
         return upload_file_list
 
     def upload_share(self, share_info_list: List[ShareInfo], upload_path='root', force=False):
@@ -463,7 +600,8 @@ class Commander:
         return folder_list, file_list
 
     def download(self, path, save_path=None, single_file=False, share=False, chunk_size=None, aria2=False,
-                 first=True, **kwargs):
+                 first=True, parallel=1, jobs=1, unpack=False, **kwargs):
+        self._req.ensure_pool_size(parallel * max(jobs, 1), 'download')
         if not chunk_size:
             chunk_size = 1048576
         if not save_path:
@@ -493,7 +631,8 @@ class Commander:
                         kwargs.update({'dir': str((save_path / path).parent.absolute()), 'out': path.name})
                         self._aria2.add_uris([self._disk.get_download_url(file_id)], Options(self._aria2, kwargs))
                     else:
-                        self.download_file(save_path / path, self._disk.get_download_url(file_id), chunk_size)
+                        self.download_file(save_path / path, self._disk.get_download_url(file_id), chunk_size,
+                                           parallel)
                 for file_id, path in file_list:
                     self._path_list.update_path_list(path.parent, depth=0, is_fid=False)
                     try:
@@ -529,13 +668,43 @@ class Commander:
                     self._print.download_info(p)
                     self._print.print_line()
                     self._path_list.update_path_list(file_node.id)
-                    self.download_file(p, file_node.download_url, chunk_size)
+                    self.download_file(p, self._disk.get_download_url(file_node.id),
+                                       chunk_size, parallel)
                 self._print.print_line()
+            elif jobs > 1 and not aria2:
+                scheduler = TransferScheduler(self._print._download_title, jobs)
+                for file_info, file_path in self.get_download_list(file_node.id, save_path / p.name):
+                    scheduler.add(file_path, file_info.size or 0, self.download_file_by_id,
+                                  args=(file_info.id, file_path, chunk_size, parallel))
+                scheduler.run()
             else:
                 self.download(self._path_list.get_fid_list(file_node.id), save_path=save_path / p.name,
-                              chunk_size=chunk_size, aria2=aria2, first=False, **kwargs)
+                              chunk_size=chunk_size, aria2=aria2, first=False, parallel=parallel, **kwargs)
+            if unpack and not file_node.type and not aria2:
+                unpack_dir(save_path / p.name)
 
-    def download_file(self, path, url, chunk_size=1048576):
+    def get_download_list(self, file_id, save_path):
+        """
+        获取文件夹下需要下载的所有文件
+        :return: [(FileInfo, 保存路径)]
+        """
+        download_list = []
+        folder_list = [(file_id, Path(save_path))]
+        while folder_list:
+            file_id, save_path = folder_list.pop()
+            if not self._path_list._tree.children(file_id):
+                self._path_list.update_path_list(file_id, depth=0)
+            for file_info in filter(self.file_filter, self._path_list.get_fid_list(file_id)):
+                if file_info.type:
+                    download_list.append((file_info, save_path / file_info.name))
+                else:
+                    folder_list.append((file_info.id, save_path / file_info.name))
+        return download_list
+
+    def download_file_by_id(self, file_id, path, chunk_size=1048576, parallel=1):
+        return self.download_file(path, self._disk.get_download_url(file_id), chunk_size, parallel)
+
+    def download_file(self, path, url, chunk_size=1048576, parallel=1):
         if not self.file_filter(path):
             return False
         try:
@@ -545,31 +714,55 @@ class Commander:
             self._print.print_line()
         except FileExistsError:
             pass
-        if path.exists():
-            temp_size = path.stat().st_size
-        else:
+        limiter_list = self._req.get_limiter_list('download')
+        if parallel and parallel > 1:
+            result = self.download_file_segments(path, url, chunk_size, parallel, limiter_list)
+            if result is not None:
+                return result
+        temp_size = path.stat().st_size if path.exists() else 0
+        state_file = path.with_name(path.name + self._state_suffix)
+        if state_file.exists():
+            # 分段下载留下的进度，只保留文件开头连续已下载的部分
+            state = self.load_download_state(path)
             temp_size = 0
+            for start, end, done in state['segments'] if state else []:
+                if start != temp_size:
+                    break
+                temp_size += done
+                if done < end - start + 1:
+                    break
+            with path.open('r+b' if path.exists() else 'wb') as f:
+                f.truncate(temp_size)
+            state_file.unlink()
         headers = {'Range': 'bytes=%d-' % temp_size}
         try:
             r = self._req.get(url, headers=headers, stream=True)
-            file_size = int(r.headers['Content-Length'])
-            if temp_size == file_size and file_size != 0:
-                self._print.print_line()
-                self._print.download_info(path, status=True)
-                return True
-            elif temp_size > file_size:
+            content_range = r.headers.get('Content-Range', '')
+            if r.status_code == 416:
+                # 本地文件不小于云盘文件
+                r.close()
+                if content_range.rsplit('/', 1)[-1] == str(temp_size) and temp_size != 0:
+                    self._print.print_line()
+                    self._print.download_info(path, status=True)
+                    return True
+                r = self._req.get(url, stream=True)
+            if r.status_code == 206 and '/' in content_range:
+                file_size = int(content_range.rsplit('/', 1)[1])
+                mode = 'ab'
+            else:
+                # 不支持断点续传，重新下载
+                file_size = int(r.headers['Content-Length'])
                 mode = 'wb'
                 temp_size = 0
-            else:
-                mode = 'ab'
             self._print.print_line()
             download_bar = DownloadBar(size=file_size)
             download_bar.update(refresh_line=False)
             with path.open(mode) as f:
                 for chunk in r.iter_content(chunk_size=chunk_size):
-                    k = temp_size / file_size
+                    k = temp_size / file_size if file_size else 1
                     download_bar.update(ratio=k, refresh_line=True)
                     if chunk:
+                        self._req.throttle(len(chunk), limiter_list)
                         temp_size += len(chunk)
                         f.write(chunk)
         except requests.exceptions.RequestException:
@@ -582,16 +775,176 @@ class Commander:
         self._print.print_line()
         return True
 
+    def load_download_state(self, path):
+        """
+        读取分段下载的进度，文件已被删除或进度无效时返回None
+        :param path: 下载的文件
+        :return: {'size': 文件大小, 'segments': [[开始, 结束, 已下载], ...]}
+        """
+        state_file = path.with_name(path.name + self._state_suffix)
+        try:
+            state = json.loads(state_file.read_text(encoding='utf-8'))
+            size = int(state['size'])
+            segments = [[int(i) for i in segment] for segment in state['segments']]
+            valid = path.is_file() and path.stat().st_size == size and all(
+                len(i) == 3 and 0 <= i[2] <= i[1] - i[0] + 1 for i in segments)
+        except (OSError, ValueError, TypeError, KeyError):
+            valid = False
+        if not valid:
+            # 文件已被删除或修改，丢弃进度重新下载
+            logger.info(f'Discard the download state of {path}.')
+            return None
+        return {'size': size, 'segments': segments}
+
+    def download_file_segments(self, path, url, chunk_size=1048576, parallel=4, limiter_list=()):
+        """
+        多连接分段下载，进度保存在同目录的.aliyunpan文件中
+        :return: 不支持分段下载时返回None
+        """
+        state_file = path.with_name(path.name + self._state_suffix)
+        state = self.load_download_state(path) if state_file.exists() else None
+        try:
+            r = self._req.get(url, headers={'Range': 'bytes=0-0'}, stream=True)
+            r.close()
+        except requests.exceptions.RequestException:
+            self._print.download_info(path, status=False)
+            self._print.print_line()
+            return False
+        if r.status_code != 206 or '/' not in r.headers.get('Content-Range', ''):
+            return None
+        file_size = int(r.headers['Content-Range'].rsplit('/', 1)[1])
+        if not state or state['size'] != file_size:
+            # 存在进度文件时文件大小相同也不一定下载完成
+            if path.exists() and path.stat().st_size == file_size and file_size != 0 and not state_file.exists():
+                self._print.download_info(path, status=True)
+                self._print.print_line()
+                return True
+            if file_size < chunk_size * 2:
+                return None
+            segment_size = -(-file_size // parallel)
+            state = {'size': file_size,
+                     'segments': [[i, min(i + segment_size, file_size) - 1, 0] for i in
+                                  range(0, file_size, segment_size)]}
+            # 预分配文件
+            with path.open('wb') as f:
+                f.truncate(file_size)
+            state_file.write_text(json.dumps(state), encoding='utf-8')
+        lock = RLock()
+        download_bar = DownloadBar(size=file_size)
+        download_bar.update(refresh_line=False)
+
+        # 已写入的字节数，刷新到磁盘后才记录到状态文件，避免记录未写入的数据
+        written = [i[2] for i in state['segments']]
+
+        def save_state():
+            with lock:
+                state_file.write_text(json.dumps(state), encoding='utf-8')
+
+        def sync_segment(f, index):
+            f.flush()
+            os.fsync(f.fileno())
+            with lock:
+                state['segments'][index][2] = written[index]
+
+        def download_segment(index):
+            start, end = state['segments'][index][:2]
+            retry_count = 0
+            save_time = time.time()
+            while start + written[index] <= end:
+                headers = {'Range': f'bytes={start + written[index]}-{end}'}
+                try:
+                    r = self._req.get(url, headers=headers, stream=True)
+                    if r.status_code != 206:
+                        raise requests.exceptions.RequestException(r.status_code)
+                    with path.open('r+b') as f:
+                        f.seek(start + written[index])
+                        try:
+                            for chunk in r.iter_content(chunk_size=chunk_size):
+                                if not chunk:
+                                    continue
+                                chunk = chunk[:end - start - written[index] + 1]
+                                self._req.throttle(len(chunk), limiter_list)
+                                f.write(chunk)
+                                with lock:
+                                    written[index] += len(chunk)
+                                    k = sum(written) / file_size
+                                download_bar.update(ratio=k, refresh_line=True)
+                                if time.time() - save_time > 1:
+                                    sync_segment(f, index)
+                                    save_state()
+                                    save_time = time.time()
+                        finally:
+                            sync_segment(f, index)
+                except requests.exceptions.RequestException:
+                    logger.warning(f'Segment {start}-{end} of {path} failed.')
+                    if retry_count >= self._req.retry_num:
+                        raise
+                    retry_count += 1
+                    time.sleep(1)
+
+        executor = ThreadPoolExecutor(max_workers=parallel)
+        try:
+            for future in as_completed([executor.submit(download_segment, index) for index, segment in
+                                        enumerate(state['segments']) if segment[0] + segment[2] <= segment[1]]):
+                future.result()
+        except requests.exceptions.RequestException:
+            save_state()
+            self._print.refresh_line()
+            self._print.download_info(path, status=False)
+            self._print.print_line()
+            return False
+        except KeyboardInterrupt:
+            save_state()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+        state_file.unlink()
+        self._print.download_info(path, status=True, t=download_bar.time, average_speed=download_bar.average_speed,
+                                  refresh_line=True)
+        self._print.print_line()
+        return True
+
     def cat(self, path, encoding='utf-8'):
         file_node = self._path_list.get_path_node(path, update=False)
         if not file_node:
-            raise FileNotFoundError(path)
+            content = self.cat_packed(path)
+            if content is None:
+                raise FileNotFoundError(path)
+            return content.decode(encoding, errors='replace')
         file = file_node.data
         self._path_list.update_path_list(file.id)
-        r = self._req.get(file.download_url)
+        r = self._req.get(self._disk.get_download_url(file.id))
         r.encoding = encoding
         return r.text
 
+    def cat_packed(self, path):
+        """
+        从打包上传的文件夹中读取单个文件，只请求该文件在分段中的范围
+        :param path: 打包前的文件路径
+        :return: 文件内容，不存在时返回None
+        """
+        path = AliyunpanPath(path)
+        parts = path.parts
+        for i in range(len(parts) - 1, 0, -1):
+            folder = AliyunpanPath(*parts[:i])
+            manifest_node = self._path_list.get_path_node(folder / manifest_name.format(parts[i - 1]), update=False)
+            if not manifest_node:
+                continue
+            manifest = Manifest.loads(self._req.get(self._disk.get_download_url(manifest_node.data.id)).content)
+            location = manifest.locate('/'.join(parts[i:]))
+            if not location:
+                return None
+            segment, offset, size = location
+            segment_node = self._path_list.get_path_node(folder / segment, update=False)
+            if not segment_node:
+                return None
+            if not size:
+                return b''
+            r = self._req.get(self._disk.get_download_url(segment_node.data.id),
+                              headers={'Range': f'bytes={offset}-{offset + size - 1}'})
+            return r.content
+        return None
+
     def share(self, path, expire_sec, share_link, download_link, save):
         if not self.file_filter(path):
             return False
@@ -607,7 +960,7 @@ class Commander:
                 file = self._path_list._tree.get_node(file_id).data
             if file.type:
                 share_txt = file.name.center(50, '-') + '\n'
-                url = self._disk.get_download_url(file.id, expire_sec, file.category)
+                url = self._disk.get_download_url(file.id, expire_sec, file.category, min_expire_sec=expire_sec)
                 if download_link:
                     share_txt += '下载链接'.center(50, '*') + '\n'
                     share_txt += url + '\n\n'
@@ -651,64 +1004,142 @@ class Commander:
         aliyunpan_tui = AliyunpanTUI(self)
         aliyunpan_tui.run()
 
-    def sync(self, path, upload_path, sync_time, time_out, chunk_size, retry, delete, first=True):
+    def sync(self, path, upload_path, sync_time, time_out, chunk_size, retry, delete, first=True, parallel=1,
+             jobs=1, watch=False, debounce=1.0):
         if first and path == 'root':
             self._print.print_info(
                 'Do you really want to synchronize the root? This operation may delete all your files.', error=True)
             input('\nEnter to continue.')
         path = AliyunpanPath(path)
-        relative_path = AliyunpanPath(path.name)
-        if str(relative_path) == '.':
-            return self.sync(path.absolute(), upload_path, sync_time, time_out, chunk_size, retry, delete,
-                             first=False)
+        if str(AliyunpanPath(path.name)) == '.':
+            path = path.absolute()
         upload_path = AliyunpanPath(upload_path)
+        kwargs = dict(time_out=time_out, chunk_size=chunk_size, retry=retry, delete=delete, parallel=parallel,
+                      jobs=jobs)
+        if watch:
+            return self.sync_watch(path, upload_path, sync_time, debounce, **kwargs)
+        while True:
+            self.sync_once(path, upload_path, first=first, **kwargs)
+            if not sync_time:
+                break
+            first = False
+            self._print.wait_info('等待{time}秒后再次同步', t=sync_time, refresh_line=True)
+            self._print.refresh_line()
+
+    def sync_once(self, path, upload_path, time_out, chunk_size, retry, delete, first=False, parallel=1, jobs=1):
+        relative_path = AliyunpanPath(path.name)
         p = upload_path / relative_path
         self._path_list.update_path_list(p, is_fid=False)
         file_id = self._path_list.get_path_fid(p, update=False)
         if not file_id:
-            self.upload(path, upload_path, timeout=time_out, chunk_size=chunk_size, retry=retry)
+            self.upload(path, upload_path, timeout=time_out, chunk_size=chunk_size, retry=retry, parallel=parallel,
+                        jobs=jobs)
             self._path_list.update_path_list(p, is_fid=False)
             file_id = self._path_list.get_path_fid(p, update=False)
-        path_ = self._path_list._tree.to_dict(file_id, with_data=True)[str(relative_path)]
-        change_file_list = self._path_list.check_path_diff(path, path_['children'] if 'children' in path_ else [])
-        change_file_list = filter(self.file_filter, change_file_list)
-        for path_ in change_file_list:
+        change_set = self._path_list.check_path_diff(path, file_id)
+        if delete:
+            path_list = filter(self.file_filter, change_set.deleted + change_set.type_changed)
+            self.rm([upload_path / (path.name / (path - path_)) for path_ in path_list])
+        for path_ in filter(self.file_filter, change_set.added + change_set.modified + change_set.type_changed):
             relative_path = path.name / (path - path_)
-            if path_.exists():
-                if not self.upload(path_, upload_path / relative_path.parent, force=True, timeout=time_out,
-                                   chunk_size=chunk_size, retry=retry, ignore=True):
-                    if first:
-                        self._print.upload_info(path_, status=False)
-                        self._print.print_line()
-            elif delete:
-                self.rm(upload_path / relative_path)
-        if sync_time:
-            self._print.wait_info('等待{time}秒后再次同步', t=sync_time, refresh_line=True)
-            self._print.refresh_line()
-            self.sync(path, upload_path, sync_time, time_out, chunk_size, retry, delete=delete, first=False)
+            if not self.upload(path_, upload_path / relative_path.parent, force=True, timeout=time_out,
+                               chunk_size=chunk_size, retry=retry, ignore=True, parallel=parallel, jobs=jobs):
+                if first:
+                    self._print.upload_info(path_, status=False)
+                    self._print.print_line()
+
+    def sync_watch(self, path, upload_path, interval, debounce, **kwargs):
+        """
+        启动时完整同步一次，之后根据本地文件变化同步
+        :param interval: 没有watchdog时扫描本地文件夹的间隔
+        :param debounce: 防抖时间
+        """
+        watcher = get_watcher(path, interval or 5.0)
+        watcher.start()
+        try:
+            self.sync_once(path, upload_path, first=True, **kwargs)
+            self._print.print_info(f'Watching {path}.')
+            self._print.print_line()
+            # 同步失败的路径保留到下一批重试
+            pending = set()
+            full_sync = False
+            while True:
+                path_set, overflow = watcher.get_events(debounce,
+                                                        self._sync_retry_interval if pending or full_sync else None)
+                pending |= path_set
+                full_sync = full_sync or overflow
+                if not pending and not full_sync:
+                    continue
+                try:
+                    if full_sync:
+                        logger.info('Too many file events, reconcile the whole folder.')
+                        self.sync_once(path, upload_path, **kwargs)
+                    else:
+                        self.sync_changes(path, upload_path, pending, **kwargs)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except (Exception, AliyunpanException):
+                    logger.error(sys.exc_info())
+                    self._print.error_info(f'同步失败，将在{self._sync_retry_interval}秒内重试')
+                    self._print.print_line()
+                    continue
+                pending.clear()
+                full_sync = False
+        finally:
+            watcher.stop()
+
+    def sync_changes(self, path, upload_path, path_set, time_out, chunk_size, retry, delete, parallel=1, jobs=1):
+        """
+        同步变化的本地路径
+        """
+        handled = set()
+        remove_list = []
+        for path_ in sorted(path_set):
+            # 父文件夹已经整个上传或删除
+            if any(parent in handled for parent in path_.parents):
+                continue
+            if not self.file_filter(path_):
+                continue
+            relative_path = path.name / (path - AliyunpanPath(path_))
+            remote_path = upload_path / relative_path
+            if path_.is_dir():
+                # 已存在的文件夹由子文件的事件处理
+                if self._path_list.get_path_fid(remote_path, update=False):
+                    continue
+                handled.add(path_)
+            elif not path_.exists():
+                handled.add(path_)
+                if delete and self._path_list.get_path_fid(remote_path, update=False):
+                    remove_list.append(remote_path)
+                continue
+            logger.info(f'Sync changed path {path_}.')
+            self.upload(path_, upload_path / relative_path.parent, force=True, timeout=time_out,
+                        chunk_size=chunk_size, retry=retry, ignore=True, parallel=parallel, jobs=jobs)
+        if remove_list:
+            self.rm(remove_list)
 
     def sync_local(self, sync_path, save_path, sync_time, chunk_size, delete, **kwargs):
         if not save_path:
             save_path = '.'
         path = AliyunpanPath(save_path) + AliyunpanPath(sync_path).name
         if not path.exists():
-            self.download(sync_path, save_path)
+            self.download(sync_path, save_path, chunk_size=chunk_size, **kwargs)
         file_id = self.path_list.get_path_fid(sync_path, update=False)
         if not file_id:
             raise FileNotFoundError(sync_path)
         self._path_list.update_path_list(sync_path, is_fid=False)
-        path_ = self._path_list._tree.to_dict(file_id, with_data=True)[str(AliyunpanPath(sync_path)).name]
-        change_file_list = self._path_list.check_path_diff(path, path_['children'] if 'children' in path_ else [])
-        for path_ in change_file_list:
+        change_set = self._path_list.check_path_diff(path, file_id)
+        # 本地多出的文件及类型不同的文件需要先删除
+        remove_list = change_set.added + change_set.type_changed if delete else change_set.type_changed
+        for path_ in remove_list:
+            path_.unlink() if path_.is_file() else shutil.rmtree(path_)
+            self._print.remove_info(path_, True)
+            self._print.print_line()
+        for path_ in change_set.modified:
+            path_.unlink()
+        for path_ in change_set.deleted + change_set.modified + change_set.type_changed:
             p = str(AliyunpanPath(path_) - AliyunpanPath(save_path))
-            file_node = self.path_list.get_path_node(p)
-            if not file_node:
-                if delete:
-                    Path(path_).unlink() if path_.is_file() else shutil.rmtree(path_)
-                    self._print.remove_info(path_, True)
-                    self._print.print_line()
-            else:
-                self.download(p, str(save_path / Path(p).parent), chunk_size=chunk_size, **kwargs)
+            self.download(p, str(save_path / Path(p).parent), chunk_size=chunk_size, **kwargs)
         if sync_time:
             self._print.wait_info('等待{time}秒后再次同步', t=sync_time, refresh_line=True)
             self._print.refresh_line()
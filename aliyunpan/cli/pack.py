@@ -0,0 +1,159 @@
+import json
+import os
+import tarfile
+from pathlib import Path, PurePosixPath
+
+from aliyunpan.api.utils import logger
+
+__all__ = ['manifest_name', 'segment_name', 'pack_dir', 'unpack_dir', 'Manifest', 'DirPacker']
+
+manifest_name = '{}.pack.json'
+segment_name = '{}.pack.{:03d}.tar'
+
+
+class Manifest:
+    """
+    打包清单，记录每个文件所在的分段及数据在分段中的偏移
+    """
+
+    def __init__(self, root, segments=None, files=None):
+        self.root = root
+        self.segments = segments or []
+        # {相对路径: [分段序号, 偏移, 大小, 修改时间]}
+        self.files = files or {}
+
+    @classmethod
+    def loads(cls, s):
+        data = json.loads(s)
+        return cls(data['root'], data['segments'], data['files'])
+
+    def dumps(self):
+        return json.dumps({'version': 1, 'root': self.root, 'segments': self.segments, 'files': self.files},
+                          ensure_ascii=False)
+
+    def locate(self, relative_path):
+        """
+        :return: (分段名, 偏移, 大小)，不存在时返回None
+        """
+        info = self.files.get(str(PurePosixPath(relative_path)))
+        if not info:
+            return None
+        return self.segments[info[0]], info[1], info[2]
+
+
+def pack_dir(path, out_dir, threshold, segment_size, file_filter=None):
+    """
+    把文件夹下的小文件打包为tar分段，分段在迭代时才写入
+    :param path: 本地文件夹
+    :param out_dir: 分段和清单的输出文件夹
+    :param threshold: 小于该大小的文件被打包
+    :param segment_size: 单个分段的大小
+    :param file_filter:
+    :return: DirPacker
+    """
+    return DirPacker(path, out_dir, threshold, segment_size, file_filter)
+
+
+class DirPacker:
+    """
+    先按文件大小划分分段，迭代时逐个写入分段，最后写入清单
+    调用方上传完一个分段后即可删除，磁盘上不需要同时保存所有分段
+    """
+
+    def __init__(self, path, out_dir, threshold, segment_size, file_filter=None):
+        self.path = Path(path)
+        self.out_dir = Path(out_dir)
+        self.manifest = Manifest(self.path.name)
+        # 已打包的文件集合
+        self.packed = set()
+        # [[(文件, 大小), ...], ...]
+        self._segments = []
+        # 估计的分段总大小
+        self.size = 0
+        segment_files = None
+        tar_size = 0
+        for root, dirs, files in os.walk(self.path):
+            dirs.sort()
+            for name in sorted(files):
+                file = Path(root) / name
+                if file_filter and not file_filter(file):
+                    continue
+                try:
+                    size = file.stat().st_size
+                except OSError:
+                    continue
+                if size >= threshold or not file.is_file():
+                    continue
+                if segment_files is None or tar_size + size > segment_size:
+                    segment_files = []
+                    self._segments.append(segment_files)
+                    tar_size = 0
+                segment_files.append((file, size))
+                tar_size += size + tarfile.BLOCKSIZE * 2
+                self.size += size + tarfile.BLOCKSIZE * 2
+                self.packed.add(file)
+
+    def __len__(self):
+        """
+        分段和清单的数量
+        """
+        return len(self._segments) + 1 if self._segments else 0
+
+    def __iter__(self):
+        """
+        :return: 依次生成分段和清单的路径
+        """
+        for files in self._segments:
+            index = len(self.manifest.segments)
+            self.manifest.segments.append(segment_name.format(self.path.name, index))
+            segment = self.out_dir / self.manifest.segments[-1]
+            with tarfile.open(segment, 'w', format=tarfile.PAX_FORMAT) as tar:
+                for file, _ in files:
+                    tar.add(str(file), arcname=file.relative_to(self.path).as_posix(), recursive=False)
+            # 重新读取头部获取每个文件数据的偏移
+            with tarfile.open(segment) as tar:
+                for info in tar.getmembers():
+                    self.manifest.files[info.name] = [index, info.offset_data, info.size, int(info.mtime)]
+            yield segment
+        if not self._segments:
+            return
+        manifest_file = self.out_dir / manifest_name.format(self.path.name)
+        manifest_file.write_text(self.manifest.dumps(), encoding='utf-8')
+        logger.info(f'Pack {len(self.packed)} files of {self.path} into {len(self.manifest.segments)} segments.')
+        yield manifest_file
+
+
+def unpack_dir(path):
+    """
+    解包文件夹下的分段，完成后删除分段和清单
+    :param path: 本地文件夹
+    :return: 解包的文件数量
+    """
+    path = Path(path)
+    manifest_file = path / manifest_name.format(path.name)
+    if not manifest_file.is_file():
+        return 0
+    manifest = Manifest.loads(manifest_file.read_text(encoding='utf-8'))
+    root = path.resolve()
+    count = 0
+    for segment in manifest.segments:
+        with tarfile.open(path / segment) as tar:
+            for info in tar.getmembers():
+                target = (root / info.name).resolve()
+                # 忽略不在文件夹内的路径
+                if not info.isfile() or root not in target.parents:
+                    logger.warning(f'Skip member {info.name} of {segment}.')
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                with tar.extractfile(info) as src, open(target, 'wb') as dst:
+                    while True:
+                        chunk = src.read(1048576)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                os.utime(target, (info.mtime, info.mtime))
+                count += 1
+        (path / segment).unlink()
+    manifest_file.unlink()
+    logger.info(f'Unpack {count} files into {path}.')
+    return count
@@ -0,0 +1,144 @@
+import itertools
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from aliyunpan.api.utils import logger, str_of_size
+from aliyunpan.common import Printer, TransferBar, thread_output
+
+__all__ = ['TransferScheduler', 'TransferResult']
+
+TransferResult = namedtuple('TransferResult', ['path', 'size', 'status', 'result', 'time', 'error'])
+
+
+class TransferScheduler:
+    """
+    并发传输多个文件，按文件大小从小到大执行
+    """
+
+    def __init__(self, title, workers=1, queue_size=None, order='size'):
+        """
+        :param title: upload或download
+        :param workers: 同时传输的文件数
+        :param queue_size: 最多同时提交的任务数
+        :param order: size按文件大小从小到大，None按添加顺序
+        """
+        self.title = title
+        self.workers = max(int(workers or 1), 1)
+        self.queue_size = queue_size or self.workers * 2
+        self.order = order
+        self._tasks = []
+        self._source = None
+        self._source_size = 0
+        self._source_count = 0
+        self._print = Printer()
+
+    def add(self, label, size, func, args=(), kwargs=None):
+        """
+        :param label: 显示在结果中的路径
+        :param size: 文件大小
+        :param func: 传输函数
+        :param args: func的位置参数
+        :param kwargs: func的关键字参数，与本方法的参数名无关，不会冲突
+        """
+        self._tasks.append((label, size, func, tuple(args), dict(kwargs or {})))
+
+    def add_source(self, source, size, count):
+        """
+        添加按完成顺序产生任务的生成器(如sha1计算完成的文件)，在已添加的任务之后按产生顺序执行
+        :param source: 生成与add参数相同的(label, size, func, args, kwargs)
+        :param size: 所有任务的总大小
+        :param count: 任务数
+        """
+        self._source = ((label, task_size, func, tuple(args), dict(kwargs or {}))
+                        for label, task_size, func, args, kwargs in source)
+        self._source_size = size
+        self._source_count = count
+
+    def __len__(self):
+        return len(self._tasks) + self._source_count
+
+    @staticmethod
+    def _run_task(label, size, func, args, kwargs, quiet):
+        if quiet:
+            thread_output(False)
+        start_time = time.time()
+        try:
+            result = func(*args, **kwargs)
+            return TransferResult(label, size, bool(result), result, time.time() - start_time, None)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Exception as e:
+            logger.error(sys.exc_info())
+            return TransferResult(label, size, False, None, time.time() - start_time, e)
+        finally:
+            if quiet:
+                thread_output(True)
+
+    def run(self, callback=None):
+        """
+        :param callback: 每个文件完成后在当前线程调用
+        :return: TransferResult列表
+        """
+        tasks = sorted(self._tasks, key=lambda x: x[1]) if self.order == 'size' else list(self._tasks)
+        total_size = sum(i[1] for i in tasks) + self._source_size or 1
+        total = len(tasks) + self._source_count
+        if self._source is not None:
+            tasks = itertools.chain(tasks, self._source)
+        self._tasks, self._source, self._source_size, self._source_count = [], None, 0, 0
+        results = []
+        if self.workers == 1:
+            for task in tasks:
+                result = self._run_task(*task, quiet=False)
+                if result.error:
+                    raise result.error
+                if callback:
+                    callback(result)
+                results.append(result)
+            return results
+        done_size = 0
+        bar = TransferBar(self.title, total_size, total)
+        bar.update(refresh_line=False)
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = set()
+        try:
+            tasks = iter(tasks)
+            while True:
+                # 限制已提交的任务数
+                while len(futures) < self.queue_size:
+                    task = next(tasks, None)
+                    if not task:
+                        break
+                    futures.add(executor.submit(self._run_task, *task, quiet=True))
+                if not futures:
+                    break
+                done, futures = wait(futures, timeout=bar.refresh_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    done_size += result.size
+                    if callback:
+                        callback(result)
+                    results.append(result)
+                bar.update(ratio=done_size / total_size, done=len(results), refresh_line=True)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+        bar.print_line()
+        self.print_results(results)
+        return results
+
+    def print_results(self, results):
+        success = sum(1 for i in results if i.status)
+        for result in sorted(results, key=lambda x: (x.status, str(x.path))):
+            size = '{:.2f}{}'.format(*str_of_size(result.size, tuple_=True))
+            error = result.error.__class__.__name__ if result.error else None
+            self._print.output = self._print.get_info(result.status, result.path, self.title, size,
+                                                      '{:.2f}s'.format(result.time), error)
+            self._print.print_line()
+        self._print.print_info(f'{self.title}: {success} succeeded, {len(results) - success} failed.',
+                               error=success != len(results))
+        self._print.print_line()
@@ -501,14 +501,15 @@ class Search(npyscreen.ActionPopup):
     def on_ok(self):
         if not self.query.value:
             self.raw.value = True
-        file_info_list = self.parentApp._cli._path_list.get_file_info(
-            self.parentApp._cli._disk.search(self.query.value, raw=self.raw.value, limit_num=int(self.limit_num.value),
-                                             limit=self.limit.value, category_list=self.category_list))
+        file_list = self.parentApp._cli._disk.iter_search(self.query.value, raw=self.raw.value,
+                                                          limit_num=int(self.limit_num.value),
+                                                          limit=self.limit.value, category_list=self.category_list)
         name = f'{time.time()} - {self.query.value}'
         self.parentApp._cli._path_list._tree.create_node(tag=name, identifier=name, parent='root',
                                                          data=FileInfo(name, name, 'root', False, time.time(),
                                                                        time.time()))
-        for i in file_info_list:
+        for info in file_list:
+            i = self.parentApp._cli._path_list.get_file_info(info)[0]
             self.parentApp._cli._path_list._tree.create_node(tag=i.name, identifier=i.id, parent=name, data=i)
         if not self.parentApp.file_grid.searched:
             self.parentApp.file_grid.searched = True
@@ -0,0 +1,144 @@
+import os
+import queue
+import time
+from pathlib import Path
+from threading import Thread, Event
+
+from aliyunpan.api.utils import logger
+
+__all__ = ['Watcher', 'PollingWatcher', 'get_watcher']
+
+
+class Watcher:
+    """
+    基于文件系统通知(watchdog)监视本地文件夹
+    """
+    # 单批事件过多时视为溢出，改为完整同步
+    max_events = 10000
+
+    def __init__(self, path):
+        self.path = Path(path).absolute()
+        self._queue = queue.Queue()
+        self.overflow = False
+        self._observer = None
+
+    def start(self):
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+        watcher = self
+
+        class Handler(FileSystemEventHandler):
+            def on_any_event(self, event):
+                if event.event_type == 'moved':
+                    watcher.put(event.src_path)
+                    watcher.put(event.dest_path)
+                elif event.event_type in ('created', 'modified', 'deleted'):
+                    watcher.put(event.src_path)
+
+        self._observer = Observer()
+        self._observer.schedule(Handler(), str(self.path), recursive=True)
+        self._observer.start()
+
+    def stop(self):
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+
+    def put(self, path):
+        path = Path(os.fsdecode(path))
+        # 文件夹本身的修改事件只代表子文件变化，子文件会单独通知
+        if path == self.path:
+            return
+        if self._queue.qsize() > self.max_events:
+            self.overflow = True
+        else:
+            self._queue.put(path)
+
+    def get_events(self, debounce=1.0, timeout=None):
+        """
+        等待文件变化，直到debounce秒内没有新事件
+        :param debounce: 防抖时间
+        :param timeout: 等待第一个事件的超时时间
+        :return: (变化的路径集合, 是否溢出)
+        """
+        path_set = set()
+        try:
+            path_set.add(self._queue.get(timeout=timeout))
+        except queue.Empty:
+            return path_set, self._reset_overflow()
+        while True:
+            try:
+                path_set.add(self._queue.get(timeout=debounce))
+            except queue.Empty:
+                break
+            if len(path_set) > self.max_events:
+                self.overflow = True
+                break
+        return path_set, self._reset_overflow()
+
+    def _reset_overflow(self):
+        overflow, self.overflow = self.overflow, False
+        if overflow:
+            # 溢出后丢弃剩余事件，由完整同步处理
+            while not self._queue.empty():
+                self._queue.get_nowait()
+        return overflow
+
+
+class PollingWatcher(Watcher):
+    """
+    没有安装watchdog时定时扫描本地文件夹，只比较文件大小和修改时间
+    """
+
+    def __init__(self, path, interval=5.0):
+        super(PollingWatcher, self).__init__(path)
+        self.interval = interval
+        self._stop = Event()
+        self._thread = None
+
+    def scan(self):
+        snapshot = {}
+        folder_list = [str(self.path)]
+        while folder_list:
+            try:
+                it = os.scandir(folder_list.pop())
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    snapshot[entry.path] = (is_dir, 0 if is_dir else stat.st_size, 0 if is_dir else stat.st_mtime_ns)
+                    if is_dir:
+                        folder_list.append(entry.path)
+        return snapshot
+
+    def _run(self, snapshot):
+        while not self._stop.wait(self.interval):
+            new_snapshot = self.scan()
+            for path in snapshot.keys() | new_snapshot.keys():
+                if snapshot.get(path) != new_snapshot.get(path):
+                    self.put(path)
+            snapshot = new_snapshot
+
+    def start(self):
+        # 启动时同步扫描，避免遗漏start返回后立即发生的变化
+        self._thread = Thread(target=self._run, args=(self.scan(),), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+
+def get_watcher(path, interval=5.0):
+    try:
+        import watchdog
+    except ImportError:
+        logger.warning('Cannot find module watchdog, fall back to polling.')
+        return PollingWatcher(path, interval)
+    return Watcher(path)
@@ -3,13 +3,14 @@ import os
 import sys
 import time
 from abc import abstractmethod
-from threading import RLock
+from threading import RLock, local
 
 from colorama import Fore, Style, Back
 
 from aliyunpan.api.utils import str_of_size
 
-__all__ = ['DATA', 'GLOBAL_VAR', 'Printer', 'Bar', 'FileBar', 'UploadBar', 'DownloadBar', 'HashBar']
+__all__ = ['DATA', 'GLOBAL_VAR', 'Printer', 'Bar', 'FileBar', 'UploadBar', 'DownloadBar', 'HashBar', 'TransferBar',
+           'thread_output']
 os.system('')
 
 
@@ -58,6 +59,12 @@ class DATA(dict):
 GLOBAL_VAR = DATA()
 GLOBAL_VAR.tasks = {}
 GLOBAL_VAR.file_set = set()
+# 当前线程是否输出，并发传输时由总进度条代替每个文件的输出
+_thread_output = local()
+
+
+def thread_output(enable=True):
+    _thread_output.enable = enable
 
 
 class Info:
@@ -206,7 +213,8 @@ class Printer(OutPut):
     output = property(lambda self: self._print.output,
                       lambda self, value: (
                           self._lock.acquire(), setattr(self._print, 'output', value),
-                          self._lock.release())[1] if self._output else None)
+                          self._lock.release())[1] if self._output and getattr(_thread_output, 'enable',
+                                                                               True) else None)
 
     def get_info(self, status, path, *args, existed=False, target_path=None, refresh_line=False):
         path_info = str(path) + self._link_info + str(target_path) if target_path else str(path)
@@ -406,3 +414,21 @@ class HashBar(FileBar):
 
     def hash_info(self, *args, **kwargs):
         super(HashBar, self).hash_info(*args, **kwargs)
+
+
+class TransferBar(FileBar):
+    def __init__(self, title, size, total, *args, **kwargs):
+        super(TransferBar, self).__init__(size=size, *args, **kwargs)
+        self._title = title
+        self._total = total
+        self._done = 0
+        self._upload_info = '{title}{:<3s} [{}{}] {:.2%} [{done}/{total}] {:.2f}{unit}/s'
+        self._output = True
+
+    def update(self, ratio=None, done=None, *args, **kwargs):
+        if done is not None:
+            self._done = done
+        super(TransferBar, self).update(ratio, *args, **kwargs)
+
+    def _format(self, *args, **kwargs):
+        return super(TransferBar, self)._format(done=self._done, total=self._total, *args, **kwargs)
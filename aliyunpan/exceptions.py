@@ -116,6 +116,8 @@ class AliyunpanCode(object):
     request_expired = 403
     part_already_exist = 409
     part_not_sequential = 400
+    too_many_requests = 429
     Forbidden = 'Forbidden'
     InvalidExpiration = 'InvalidParameter.Expiration'
     FileShareNotAllowed = 'FileShareNotAllowed'
+    pre_hash_matched = 'PreHashMatched'
@@ -26,15 +26,26 @@ __all__ = ['main']
 @click.option('-f', '--filter-file', multiple=True, type=click.STRING, help='Filter files.')
 @click.option('-w', '--whitelist', is_flag=True, help='Filter files using whitelist.')
 @click.option('-m', '--match', is_flag=True, help='Specify to use regular matching files.')
+@click.option('--rehash', is_flag=True, help='Ignore the local hash cache and recalculate sha1.')
+@click.option('--cache-ttl', type=click.FLOAT, help='File tree cache expiration time(sec), 0 to disable.', default=600,
+              show_default=True)
+@click.option('--pool-size', type=click.INT, help='Connection pool size per host.', default=16, show_default=True)
+@click.option('--upload-limit', type=click.INT, help='Total upload bandwidth limit(byte/sec).')
+@click.option('--download-limit', type=click.INT, help='Total download bandwidth limit(byte/sec).')
+@click.option('--file-limit', type=click.INT, help='Bandwidth limit per file(byte/sec).')
+@click.option('--request-limit', type=click.FLOAT, help='Api request rate limit(requests/sec).')
 def cli(config_file, refresh_token, username, password, depth, debug, timeout, drive_id, album, share_id, share_pwd,
-        filter_file, whitelist, match):
+        filter_file, whitelist, match, rehash, cache_ttl, pool_size, upload_limit, download_limit, file_limit,
+        request_limit):
     logger.info(f'Version:{__version__}')
     if debug:
         logger.setLevel('DEBUG')
     commander.init(config_file=None if refresh_token or username else config_file,
                    refresh_token=None if username else refresh_token, username=username, password=password, depth=depth,
                    timeout=timeout, drive_id=drive_id, album=album, share_id=share_id, share_pwd=share_pwd,
-                   filter_file=set(filter_file), whitelist=whitelist, match=match)
+                   filter_file=set(filter_file), whitelist=whitelist, match=match, rehash=rehash,
+                   cache_ttl=cache_ttl, pool_size=pool_size, upload_limit=upload_limit, download_limit=download_limit,
+                   file_limit=file_limit, request_limit=request_limit)
 
 
 @cli.command(aliases=['l', 'list', 'dir'], help='List files.')
@@ -55,7 +66,7 @@ def search(query, l):
 
 @cli.command(aliases=['delete', 'del'], help='Delete Files.')
 @click.help_option('-h', '--help')
-@click.argument('path', type=click.Path())
+@click.argument('path', type=click.Path(), nargs=-1, required=True)
 def rm(path):
     commander.rm(path)
 
@@ -87,12 +98,25 @@ def mv(path, target_path):
 @click.option('-s', '--share', is_flag=True, help='Specify the shared sequence file.')
 @click.option('-cs', '--chunk-size', type=click.INT, help='Chunk size(byte).')
 @click.option('-c', is_flag=True, help='Breakpoint continuation.')
-def upload(path, file, upload_path, time_out, retry, force, share, chunk_size, c):
+@click.option('-P', '--parallel', type=click.INT, help='Number of chunks uploaded in parallel.', default=1,
+              show_default=True)
+@click.option('-j', '--jobs', type=click.INT, help='Number of files transferred concurrently.', default=1,
+              show_default=True)
+@click.option('--pack', is_flag=True, help='Pack small files into tar segments.')
+@click.option('--pack-threshold', type=click.INT, help='Files smaller than this are packed(byte).', default=1048576,
+              show_default=True)
+@click.option('--pack-size', type=click.INT, help='Size of each tar segment(byte).', default=1073741824,
+              show_default=True)
+@click.option('--hash-jobs', type=click.INT, default=0, show_default=True,
+              help='Number of files hashed concurrently when uploading folders, 0 to hash while uploading.')
+def upload(path, file, upload_path, time_out, retry, force, share, chunk_size, c, parallel, jobs, pack,
+           pack_threshold, pack_size, hash_jobs):
     if not path and not file:
         raise click.MissingParameter(param=click.get_current_context().command.params[2])
     else:
         path_list = set(filter(None, {*file, path}))
-    commander.upload(path_list, upload_path, time_out, retry, force, share, chunk_size, c)
+    commander.upload(path_list, upload_path, time_out, retry, force, share, chunk_size, c, parallel=parallel, jobs=jobs,
+                     pack=pack, pack_threshold=pack_threshold, pack_size=pack_size, hash_jobs=hash_jobs)
 
 
 @cli.command(aliases=['m'], help='Create folder.')
@@ -111,8 +135,13 @@ def mkdir(path):
 @click.option('-s', 'share', is_flag=True, help='Specify the shared sequence file')
 @click.option('-cs', '--chunk-size', type=click.INT, help='Chunk size(byte).', default=1048576, show_default=True)
 @click.option('-a', '--aria2', is_flag=True, help='Send to aria2.')
+@click.option('-P', '--parallel', type=click.INT, help='Number of connections per file.', default=1,
+              show_default=True)
+@click.option('-j', '--jobs', type=click.INT, help='Number of files transferred concurrently.', default=1,
+              show_default=True)
+@click.option('--unpack', is_flag=True, help='Unpack tar segments created by upload --pack.')
 @click.pass_context
-def download(ctx, path, file, save_path, share, chunk_size, aria2):
+def download(ctx, path, file, save_path, share, chunk_size, aria2, parallel, jobs, unpack):
     if not path and not file:
         raise click.MissingParameter(param=click.get_current_context().command.params[2])
     else:
@@ -123,7 +152,8 @@ def download(ctx, path, file, save_path, share, chunk_size, aria2):
             kwargs[i.split('=')[0]] = i.split('=')[1]
         else:
             kwargs[i.strip('-')] = True
-    commander.download(file_list, save_path=save_path, share=share, chunk_size=chunk_size, aria2=aria2, **kwargs)
+    commander.download(file_list, save_path=save_path, share=share, chunk_size=chunk_size, aria2=aria2,
+                       parallel=parallel, jobs=jobs, unpack=unpack, **kwargs)
 
 
 @cli.command(aliases=['t', 'show'], help='View file tree.')
@@ -179,8 +209,16 @@ def cat(path, encoding):
 @click.option('-n', '--no-delete', is_flag=True, help='Do not delete the cloud/local files.')
 @click.option('-d', '--delete', is_flag=True, help='Allow deletion of cloud/local files.')
 @click.option('-l', '--local', is_flag=True, help='Sync cloud drive files to local.')
+@click.option('-P', '--parallel', type=click.INT, help='Number of chunks uploaded in parallel.', default=1,
+              show_default=True)
+@click.option('-j', '--jobs', type=click.INT, help='Number of files transferred concurrently.', default=1,
+              show_default=True)
+@click.option('-w', '--watch', is_flag=True, help='Watch local file changes instead of rescanning.')
+@click.option('--debounce', type=click.FLOAT, help='Wait time(sec) for file changes to settle.', default=1.0,
+              show_default=True)
 @click.pass_context
-def sync(ctx, local_path, remote_path, time_out, chunk_size, retry, sync_time, no_delete, delete, local):
+def sync(ctx, local_path, remote_path, time_out, chunk_size, retry, sync_time, no_delete, delete, local, parallel,
+         jobs, watch, debounce):
     kwargs = {}
     for i in ctx.args:
         if '=' in i:
@@ -188,9 +226,10 @@ def sync(ctx, local_path, remote_path, time_out, chunk_size, retry, sync_time, n
         else:
             kwargs[i.strip('-')] = True
     if local:
-        commander.sync_local(remote_path, local_path, sync_time, chunk_size, delete, **kwargs)
+        commander.sync_local(remote_path, local_path, sync_time, chunk_size, delete, jobs=jobs, **kwargs)
     else:
-        commander.sync(local_path, remote_path, sync_time, time_out, chunk_size, retry, delete)
+        commander.sync(local_path, remote_path, sync_time, time_out, chunk_size, retry, delete, parallel=parallel,
+                       jobs=jobs, watch=watch, debounce=debounce)
 
 
 @cli.command(aliases=['tui'], help='Text-based User Interface.')
@@ -51,6 +51,9 @@ setup(
     packages=['aliyunpan', 'aliyunpan/api', 'aliyunpan/cli', 'dlnap/dlnap'],
     python_requires='>=3.6, <4',
     install_requires=install_requires,
+    extras_require={
+        'aio': ['aiohttp>=3.7'],
+    },
     data_files=[
         'requirements.txt'
     ],
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# 缓存、日志和任务文件写入临时目录，需要在导入aliyunpan之前设置
+os.environ.setdefault('ALIYUNPAN_ROOT', tempfile.mkdtemp(prefix='aliyunpan-test-'))
@@ -0,0 +1,93 @@
+import os
+import time
+
+from aliyunpan.api.cache import HashCache, TaskJournal, UrlCache
+
+
+def test_url_cache_expiry():
+    cache = UrlCache()
+    cache.clear()
+    cache.set('drive', 'file', 'url', 14400)
+    # 默认的有效时间下链接可以一直使用到过期前
+    cache._urls[('drive', 'file')] = ('url', time.time() + 3600)
+    assert cache.get('drive', 'file') == 'url'
+    # 需要更长有效时间的调用方不使用缓存
+    assert cache.get('drive', 'file', min_expire_sec=14400) is None
+    assert cache.get('drive', 'file', min_expire_sec=3600) == 'url'
+    # 即将过期的链接不再使用
+    cache._urls[('drive', 'file')] = ('url', time.time() + cache.margin - 1)
+    assert cache.get('drive', 'file') is None
+
+
+def test_url_cache_response_expiration():
+    cache = UrlCache()
+    cache.clear()
+    cache.set('drive', 'file', 'url', 14400, expire_time=time.time() + cache.margin / 2)
+    assert cache.get('drive', 'file') is None
+    cache.set('drive', 'file', 'url', 60, expire_time=time.time() + 7200)
+    assert cache.get('drive', 'file', min_expire_sec=7200) == 'url'
+
+
+def test_url_cache_persist():
+    cache = UrlCache()
+    cache.clear()
+    cache.persist = True
+    try:
+        cache.set_many('drive', [('a', 'url_a'), ('b', None)], 14400)
+        cache._urls.clear()
+        assert cache.get('drive', 'a') == 'url_a'
+        assert cache.get('drive', 'b') is None
+        cache.invalidate('drive', 'a')
+        assert cache.get('drive', 'a') is None
+    finally:
+        cache.persist = False
+
+
+def test_hash_cache(tmp_path):
+    cache = HashCache()
+    path = tmp_path / 'file'
+    path.write_bytes(b'data')
+    assert cache.get(path) is None
+    cache.set(path, 'ABC')
+    assert cache.get(path) == 'abc'
+    # 修改文件后缓存失效
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+    assert cache.get(path) is None
+    cache.set(path, 'def')
+    cache.rehash = True
+    try:
+        assert cache.get(path) is None
+    finally:
+        cache.rehash = False
+    assert cache.get(path) == 'def'
+
+
+def test_task_journal_replay(tmp_path):
+    db_file = tmp_path / 'tasks.db'
+    journal = TaskJournal(db_file)
+    journal['a'] = {'path': 'a', 'upload_id': 'u'}
+    journal['b'] = {'path': 'b'}
+    journal['a']['part_number'] = 3
+    del journal['a']['upload_id']
+    del journal['b']
+    # 不调用close，模拟程序被强制结束
+    journal._conn = None
+    journal = TaskJournal(db_file)
+    assert list(journal) == ['a']
+    assert journal['a'] == {'path': 'a', 'part_number': 3}
+    journal['a']['part_number'] = 4
+    journal.close()
+    assert journal.execute('SELECT COUNT(*) FROM task_log') == [(0,)]
+    assert TaskJournal(db_file)['a']['part_number'] == 4
+
+
+def test_task_journal_compact(tmp_path):
+    db_file = tmp_path / 'tasks.db'
+    journal = TaskJournal(db_file, compact_size=5)
+    for i in range(12):
+        journal[str(i % 3)] = {'count': i}
+    assert journal._log_count < 5
+    journal._conn = None
+    journal = TaskJournal(db_file)
+    assert {key: journal[key]['count'] for key in journal} == {'0': 9, '1': 10, '2': 11}
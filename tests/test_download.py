@@ -0,0 +1,140 @@
+import http.server
+import json
+import os
+import re
+import threading
+
+import pytest
+
+from aliyunpan.cli.cli import Commander
+
+DATA = os.urandom(3 * 1024 * 1024 + 17)
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if not match:
+            self.send_response(200)
+            body = DATA
+        else:
+            start = int(match.group(1))
+            end = int(match.group(2) or len(DATA) - 1)
+            if start >= len(DATA):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(DATA)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = DATA[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{start + len(body) - 1}/{len(DATA)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RangeServer(http.server.ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # 中断下载时客户端会断开连接
+        pass
+
+
+@pytest.fixture(scope='module')
+def url():
+    server = RangeServer(('127.0.0.1', 0), RangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}/file'
+    server.shutdown()
+
+
+@pytest.fixture
+def commander():
+    commander = Commander(init=False)
+    commander._disk._access_token = 'token'
+    return commander
+
+
+def interrupt_after(commander, count):
+    """
+    下载count块后模拟程序被强制结束
+    """
+    throttle = commander._req.throttle
+    calls = []
+
+    def fake_throttle(size, limiter_list=()):
+        calls.append(size)
+        if len(calls) == count:
+            raise KeyboardInterrupt
+        return throttle(size, limiter_list)
+
+    commander._req.throttle = fake_throttle
+    return throttle
+
+
+def test_segments_download(commander, url, tmp_path):
+    path = tmp_path / 'file'
+    assert commander.download_file(path, url, 262144, parallel=4)
+    assert path.read_bytes() == DATA
+    assert not (tmp_path / 'file.aliyunpan').exists()
+
+
+def test_interrupted_segments_resume_single_stream(commander, url, tmp_path):
+    path = tmp_path / 'file'
+    throttle = interrupt_after(commander, 5)
+    with pytest.raises(KeyboardInterrupt):
+        commander.download_file(path, url, 262144, parallel=4)
+    # 文件已预分配为完整大小，只能根据进度文件续传
+    assert path.stat().st_size == len(DATA)
+    state = json.loads((tmp_path / 'file.aliyunpan').read_text())
+    data = path.read_bytes()
+    for start, end, done in state['segments']:
+        assert data[start:start + done] == DATA[start:start + done]
+    commander._req.throttle = throttle
+    assert commander.download_file(path, url, 262144, parallel=1)
+    assert path.read_bytes() == DATA
+    assert not (tmp_path / 'file.aliyunpan').exists()
+
+
+def test_interrupted_segments_resume_segments(commander, url, tmp_path):
+    path = tmp_path / 'file'
+    throttle = interrupt_after(commander, 5)
+    with pytest.raises(KeyboardInterrupt):
+        commander.download_file(path, url, 262144, parallel=4)
+    commander._req.throttle = throttle
+    assert commander.download_file(path, url, 262144, parallel=4)
+    assert path.read_bytes() == DATA
+
+
+def test_corrupt_state_restarts(commander, url, tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'\0' * len(DATA))
+    (tmp_path / 'file.aliyunpan').write_text('{broken')
+    assert commander.download_file(path, url, 262144, parallel=4)
+    assert path.read_bytes() == DATA
+    path.write_bytes(b'\0' * len(DATA))
+    (tmp_path / 'file.aliyunpan').write_text('{broken')
+    assert commander.download_file(path, url, 262144, parallel=1)
+    assert path.read_bytes() == DATA
+
+
+def test_state_without_file_restarts(commander, url, tmp_path):
+    path = tmp_path / 'file'
+    (tmp_path / 'file.aliyunpan').write_text(json.dumps({'size': len(DATA), 'segments': [[0, len(DATA) - 1, 100]]}))
+    assert commander.download_file(path, url, 262144, parallel=4)
+    assert path.read_bytes() == DATA
+
+
+def test_single_stream_resume(commander, url, tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(DATA[:1000000])
+    assert commander.download_file(path, url, 262144, parallel=1)
+    assert path.read_bytes() == DATA
+    # 已下载完成
+    assert commander.download_file(path, url, 262144, parallel=1)
+    assert path.read_bytes() == DATA
@@ -0,0 +1,34 @@
+import hashlib
+import os
+
+from aliyunpan.api.cache import HashCache
+from aliyunpan.api.hasher import HashService
+
+
+def test_hash_service(tmp_path):
+    path_list = []
+    for i in range(5):
+        path = tmp_path / str(i)
+        path.write_bytes(os.urandom(100000 * i))
+        path_list.append(path)
+    missing = tmp_path / 'missing'
+    service = HashService(3, buffer_size=65536)
+    result = dict(service.imap(path_list + [missing], progress=False))
+    assert result.pop(missing) is None
+    assert {path: sha1.lower() for path, sha1 in result.items()} == {
+        path: hashlib.sha1(path.read_bytes()).hexdigest() for path in path_list}
+    # 计算结果写入缓存，再次计算时不读取文件
+    assert all(HashCache().get(path).lower() == result[path].lower() for path in path_list)
+    assert dict(service.imap(path_list, progress=False)) == result
+    assert service._size == 0
+
+
+def test_hash_service_rehash(tmp_path):
+    path = tmp_path / 'file'
+    path.write_bytes(b'data')
+    HashCache().set(path, 'stale')
+    HashCache().rehash = True
+    try:
+        assert HashService(1).hash_file(path).lower() == hashlib.sha1(b'data').hexdigest()
+    finally:
+        HashCache().rehash = False
@@ -0,0 +1,76 @@
+import os
+from pathlib import Path
+
+import pytest
+
+from aliyunpan.cli.pack import Manifest, manifest_name, pack_dir, unpack_dir
+
+
+@pytest.fixture
+def folder(tmp_path):
+    path = tmp_path / 'src'
+    (path / 'sub' / 'deep').mkdir(parents=True)
+    (path / 'big').mkdir()
+    (path / 'a.txt').write_bytes(b'a' * 100)
+    (path / 'sub' / 'b.txt').write_bytes(b'b' * 2000)
+    (path / 'sub' / 'deep' / 'c.txt').write_bytes(b'c' * 10)
+    (path / 'big' / 'd.bin').write_bytes(os.urandom(10000))
+    return path
+
+
+def test_pack_roundtrip(folder, tmp_path):
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+    packer = pack_dir(folder, out_dir, threshold=4096, segment_size=4000)
+    assert packer.packed == {folder / 'a.txt', folder / 'sub' / 'b.txt', folder / 'sub' / 'deep' / 'c.txt'}
+    file_list = list(packer)
+    assert len(file_list) == len(packer) == 3
+    assert file_list[-1].name == manifest_name.format('src')
+
+    # 清单中的偏移可以直接读取分段中的文件数据
+    manifest = Manifest.loads(file_list[-1].read_text(encoding='utf-8'))
+    for name in ('a.txt', 'sub/b.txt', 'sub/deep/c.txt'):
+        segment, offset, size = manifest.locate(name)
+        with open(out_dir / segment, 'rb') as f:
+            f.seek(offset)
+            assert f.read(size) == (folder / name).read_bytes()
+    assert manifest.locate('big/d.bin') is None
+
+    target = tmp_path / 'dst' / 'src'
+    target.mkdir(parents=True)
+    for file in file_list:
+        file.rename(target / file.name)
+    assert unpack_dir(target) == 3
+    for name in ('a.txt', 'sub/b.txt', 'sub/deep/c.txt'):
+        assert (target / name).read_bytes() == (folder / name).read_bytes()
+    assert sorted(i.name for i in target.iterdir()) == ['a.txt', 'sub']
+
+
+def test_pack_nothing(folder, tmp_path):
+    packer = pack_dir(folder, tmp_path, threshold=1, segment_size=3000)
+    assert len(packer) == 0
+    assert list(packer) == []
+    assert unpack_dir(folder) == 0
+
+
+def test_upload_dir_skip_packed_folders(folder, tmp_path):
+    from aliyunpan.cli.cli import Commander
+    commander = Commander(init=False)
+    folder_list = []
+
+    def mkdir(path, *args, **kwargs):
+        # 与Commander.mkdir一致，先创建不存在的父文件夹
+        path = Path(path)
+        folder_list.extend(i for i in reversed(path.parents) if i != Path('/') and i not in folder_list)
+        folder_list.append(path)
+
+    commander.mkdir = mkdir
+    commander._path_list.get_path_fid = lambda path, *args, **kwargs: Path(path) in folder_list and 'id'
+    packer = pack_dir(folder, tmp_path, threshold=4096, segment_size=3000)
+    upload_file_list = commander.upload_dir(folder, Path('/'), packer.packed)
+    assert upload_file_list == [[Path('/src/big'), folder / 'big' / 'd.bin']]
+    assert folder_list == [Path('/src'), Path('/src/big')]
+
+    folder_list.clear()
+    assert len(commander.upload_dir(folder, Path('/'))) == 4
+    assert set(folder_list) == {Path('/src'), Path('/src/big'), Path('/src/sub'), Path('/src/sub/deep')}
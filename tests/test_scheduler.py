@@ -0,0 +1,68 @@
+import threading
+import time
+
+import pytest
+
+from aliyunpan.cli.scheduler import TransferScheduler
+
+
+def upload(path, delay=0.0, fail=False):
+    time.sleep(delay)
+    if fail:
+        raise ValueError(path)
+    return path
+
+
+def test_scheduler_order():
+    scheduler = TransferScheduler('upload')
+    for name, size in (('c', 3), ('a', 1), ('b', 2)):
+        # kwargs中的path等参数与add的参数名不冲突
+        scheduler.add(name, size, upload, kwargs={'path': name})
+    assert len(scheduler) == 3
+    assert [i.result for i in scheduler.run()] == ['a', 'b', 'c']
+    assert len(scheduler) == 0
+
+
+def test_scheduler_source():
+    scheduler = TransferScheduler('upload', workers=3)
+    scheduler.add('big', 100, upload, ('big',))
+    scheduler.add_source(((str(i), 1, upload, (str(i),), {'delay': 0.01}) for i in range(10)), 10, 10)
+    assert len(scheduler) == 11
+    results = scheduler.run()
+    assert sorted(i.result for i in results) == sorted(['big'] + [str(i) for i in range(10)])
+    assert all(i.status for i in results)
+
+
+def test_scheduler_concurrency():
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def task():
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return True
+
+    scheduler = TransferScheduler('upload', workers=4)
+    for i in range(12):
+        scheduler.add(str(i), 1, task)
+    scheduler.run()
+    assert 1 < running[1] <= 4
+
+
+def test_scheduler_error():
+    scheduler = TransferScheduler('upload', workers=2)
+    scheduler.add('ok', 1, upload, ('ok',))
+    scheduler.add('fail', 2, upload, ('fail',), {'fail': True})
+    results = {i.path: i for i in scheduler.run()}
+    assert results['ok'].status
+    assert not results['fail'].status and isinstance(results['fail'].error, ValueError)
+
+    # 单线程时直接抛出异常
+    scheduler = TransferScheduler('upload')
+    scheduler.add('fail', 1, upload, ('fail',), {'fail': True})
+    with pytest.raises(ValueError):
+        scheduler.run()
@@ -0,0 +1,33 @@
+from aliyunpan.cli.watch import PollingWatcher, Watcher
+
+
+def test_polling_watcher(tmp_path):
+    (tmp_path / 'a').write_bytes(b'a')
+    (tmp_path / 'sub').mkdir()
+    watcher = PollingWatcher(tmp_path, interval=0.05)
+    watcher.start()
+    try:
+        (tmp_path / 'a').write_bytes(b'ab')
+        (tmp_path / 'sub' / 'b').write_bytes(b'b')
+        path_set, overflow = watcher.get_events(debounce=0.3, timeout=5)
+    finally:
+        watcher.stop()
+    assert not overflow
+    assert {tmp_path / 'a', tmp_path / 'sub' / 'b'} <= path_set
+
+
+def test_watcher_ignores_root(tmp_path):
+    watcher = Watcher(tmp_path)
+    watcher.put(str(tmp_path))
+    assert watcher.get_events(debounce=0, timeout=0.01) == (set(), False)
+
+
+def test_watcher_overflow(tmp_path):
+    watcher = Watcher(tmp_path)
+    watcher.max_events = 3
+    for i in range(10):
+        watcher.put(str(tmp_path / str(i)))
+    path_set, overflow = watcher.get_events(debounce=0.01)
+    assert overflow
+    # 溢出后剩余事件被丢弃
+    assert watcher.get_events(debounce=0, timeout=0.01) == (set(), False)